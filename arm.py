@@ -24,17 +24,62 @@
 The library to control the arm.
 '''
 
+from concurrent.futures import Future
+import logging
+import math
+import os
+import threading
 import usb.core
 import usb.util
 import time
+import metrics
 
 
-class Component():
+def send(usb_arm, cmd):
+    start = time.perf_counter()
+    try:
+        usb_arm.ctrl_transfer(0x40, 6, 0x100, 0, cmd, 1000)
+    except Exception as e:
+        metrics.count_transfer_error(e)
+        raise
+    finally:
+        metrics.USB_TRANSFER_SECONDS.observe(time.perf_counter() - start)
+
+
+class PackedState():
+    '''
+    The states of all components of an arm packed into one integer, two bits
+    per component.
+    '''
 
     def __init__(self):
-        self.state = 0
+        self.value = 0
+
+
+class Component():
+
+    # the position of the two state bits in the packed state and the byte of
+    # the move command the state is added to
+    shift = 0
+    byte = 0
+    reversible = True
+    states = {'stop': 0, 'up': 1, 'down': 2}
+
+    def __init__(self, packed=None):
+        if packed is None:
+            packed = PackedState()
+        self.packed = packed
         self.factor = 1
 
+    @property
+    def state(self):
+        return (self.packed.value >> self.shift) & 3
+
+    @state.setter
+    def state(self, s):
+        self.packed.value = ((self.packed.value & ~(3 << self.shift))
+                             | (s << self.shift))
+
     def set_stop(self):
         self.state = 0
 
@@ -68,8 +113,12 @@ class Component():
 
 class Base(Component):
 
-    def __init__(self):
-        Component.__init__(self)
+    shift = 8
+    byte = 1
+    states = {'stop': 0, 'clockwise': 1, 'anticlockwise': 2}
+
+    def __init__(self, packed=None):
+        Component.__init__(self, packed)
         self.factor = 1
 
     def set_clockwise(self):
@@ -91,29 +140,38 @@ class Base(Component):
 
 class Shoulder(Component):
 
-    def __init__(self):
-        Component.__init__(self)
+    shift = 6
+
+    def __init__(self, packed=None):
+        Component.__init__(self, packed)
         self.factor = 64
 
 
 class Elbow(Component):
 
-    def __init__(self):
-        Component.__init__(self)
+    shift = 4
+
+    def __init__(self, packed=None):
+        Component.__init__(self, packed)
         self.factor = 16
 
 
 class Wrist(Component):
 
-    def __init__(self):
-        Component.__init__(self)
+    shift = 2
+
+    def __init__(self, packed=None):
+        Component.__init__(self, packed)
         self.factor = 4
 
 
 class Gripper(Component):
 
-    def __init__(self):
-        Component.__init__(self)
+    shift = 0
+    states = {'stop': 0, 'close': 1, 'open': 2}
+
+    def __init__(self, packed=None):
+        Component.__init__(self, packed)
         self.factor = 1
 
     def set_close(self):
@@ -135,8 +193,13 @@ class Gripper(Component):
 
 class Light(Component):
 
-    def __init__(self):
-        Component.__init__(self)
+    shift = 10
+    byte = 2
+    reversible = False
+    states = {'off': 0, 'on': 1}
+
+    def __init__(self, packed=None):
+        Component.__init__(self, packed)
         self.factor = 1
 
     def set_on(self):
@@ -154,24 +217,509 @@ class Light(Component):
         return s
 
 
+COMPONENTS = [('base', Base), ('shoulder', Shoulder), ('elbow', Elbow),
+              ('wrist', Wrist), ('gripper', Gripper), ('light', Light)]
+
+
+def build_move_tables():
+    '''
+    Returns two lists which map every packed state to its move command and
+    to its reversed move command.
+    '''
+    components = [cls() for name, cls in COMPONENTS]
+    forward = []
+    reverse = []
+    for value in range(1 << 12):
+        cmd = [0, 0, 0]
+        cmd_reverse = [0, 0, 0]
+        for c in components:
+            c.packed.value = value
+            cmd[c.byte] = cmd[c.byte] + c.compute_move()
+            if c.reversible is True:
+                cmd_reverse[c.byte] = (cmd_reverse[c.byte]
+                                       + c.compute_move_reverse())
+            else:
+                cmd_reverse[c.byte] = cmd_reverse[c.byte] + c.compute_move()
+        forward.append(tuple(cmd))
+        reverse.append(tuple(cmd_reverse))
+    return forward, reverse
+
+
+MOVE_TABLE, MOVE_REVERSE_TABLE = build_move_tables()
+COMPONENT_NAMES = [name for name, cls in COMPONENTS]
+
+
+class UsbWriter():
+    '''
+    Sends move commands to the arm from a background thread. Only the latest
+    published command is sent, commands which are superseded before they
+    were sent are dropped. Two transfers are at least min_interval seconds
+    apart.
+    '''
+
+    def __init__(self, usb_arm, min_interval=0.0):
+        self.usb_arm = usb_arm
+        self.min_interval = min_interval
+        self.cond = threading.Condition()
+        self.pending = None
+        self.futures = []
+        self.running = True
+        self.last_sent = 0.0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def publish(self, cmd):
+        '''
+        Replaces the pending command and returns a future, which is resolved
+        with the command actually sent once the transfer finished.
+        '''
+        future = Future()
+        with self.cond:
+            self.pending = cmd
+            self.futures.append(future)
+            self.cond.notify()
+        return future
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.pending is None and self.running is True:
+                    self.cond.wait()
+                if self.pending is None:
+                    return
+            wait = self.last_sent + self.min_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            with self.cond:
+                cmd = self.pending
+                futures = self.futures
+                self.pending = None
+                self.futures = []
+            try:
+                send(self.usb_arm, cmd)
+            except Exception as e:
+                for f in futures:
+                    f.set_exception(e)
+            else:
+                for f in futures:
+                    f.set_result(cmd)
+            self.last_sent = time.monotonic()
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join()
+
+
+class TimedMove():
+    '''
+    The handle of a timed move. states maps the names of the moved
+    components to the states they are stopped from when the move expires.
+    '''
+
+    def __init__(self, states):
+        self.states = states
+        self.cancelled = False
+        self.error = None
+        self.done = threading.Event()
+
+    def cancel(self):
+        '''
+        Keeps the components moving instead of stopping them at the expiry.
+        '''
+        self.cancelled = True
+        self.done.set()
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+
+class TimerWheel():
+    '''
+    Expires timed moves on a single thread. Time is divided into ticks of
+    resolution seconds, kept in a ring of slots, and all handles expiring in
+    the same tick are passed to the callback together.
+    '''
+
+    def __init__(self, callback, resolution=0.01, num_slots=256):
+        self.callback = callback
+        self.resolution = resolution
+        self.slots = [[] for i in range(num_slots)]
+        self.num_pending = 0
+        self.origin = time.monotonic()
+        self.tick = 0
+        self.cond = threading.Condition()
+        self.running = True
+        self.thread = None
+
+    def current_tick(self):
+        return int((time.monotonic() - self.origin) / self.resolution)
+
+    def schedule(self, delay, handle):
+        with self.cond:
+            if self.num_pending == 0:
+                self.tick = self.current_tick()
+            target = self.current_tick() + max(
+                1, int(math.ceil(delay / self.resolution)))
+            self.slots[target % len(self.slots)].append((target, handle))
+            self.num_pending = self.num_pending + 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify()
+        return handle
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.num_pending == 0 and self.running is True:
+                    self.cond.wait()
+                if self.running is False:
+                    return
+                wait = (self.origin + (self.tick + 1) * self.resolution
+                        - time.monotonic())
+                if wait > 0:
+                    self.cond.wait(wait)
+                now = self.current_tick()
+                expired = []
+                while self.tick < now and self.num_pending > 0:
+                    self.tick = self.tick + 1
+                    slot = self.slots[self.tick % len(self.slots)]
+                    keep = []
+                    for target, handle in slot:
+                        if target <= self.tick:
+                            expired.append(handle)
+                        else:
+                            keep.append((target, handle))
+                    self.num_pending = (self.num_pending
+                                        - len(slot) + len(keep))
+                    slot[:] = keep
+                if self.num_pending == 0:
+                    self.tick = now
+            expired = [h for h in expired if h.cancelled is False]
+            if len(expired) > 0:
+                try:
+                    self.callback(expired)
+                except Exception:
+                    # the wheel keeps expiring the later moves
+                    logging.exception('TimerWheel: expiring moves failed')
+
+    def close(self):
+        '''
+        Stops the wheel and cancels the pending handles, so nobody waits for
+        them forever.
+        '''
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+        with self.cond:
+            pending = [handle for slot in self.slots for target, handle in slot]
+            for slot in self.slots:
+                del slot[:]
+            self.num_pending = 0
+        for handle in pending:
+            handle.cancel()
+
+
+class PwmEngine():
+    '''
+    Moves joints with a proportional speed by switching them on and off in
+    ticks of period seconds. Every joint adds the magnitude of its speed,
+    between -1.0 and 1.0, to an accumulator each tick and runs in the ticks
+    its accumulator overflows, so over time it runs the given fraction of
+    the ticks. All joints are changed with one transfer per tick. Ticks
+    which start more than jitter_bound seconds late are counted as
+    overruns, ticks missed completely are skipped and not caught up.
+    '''
+
+    def __init__(self, arm, period=0.02, jitter_bound=0.002,
+                 clock=time.monotonic_ns, sleep=time.sleep):
+        self.arm = arm
+        self.period = int(period * 1e9)
+        self.jitter_bound = int(jitter_bound * 1e9)
+        self.clock = clock
+        self.sleep = sleep
+        self.speeds = {}
+        self.accumulators = {}
+        self.cond = threading.Condition()
+        self.running = True
+        self.thread = None
+        self.num_ticks = 0
+        self.num_overruns = 0
+        self.num_skipped = 0
+        self.max_jitter = 0
+        self.sum_jitter = 0
+
+    def set_speeds(self, speeds):
+        '''
+        Sets the speeds of several joints, for example {'base': 0.5,
+        'shoulder': -0.25}. Positive speeds run a joint in its state 1 (up,
+        clockwise or close), negative ones in its state 2.
+        '''
+        for name in speeds:
+            if name not in COMPONENT_NAMES:
+                raise ValueError('Unknown component: %s' % name)
+            if getattr(self.arm, name).reversible is False:
+                raise ValueError('%s has no speed' % name)
+        with self.cond:
+            for name, speed in speeds.items():
+                speed = max(-1.0, min(1.0, float(speed)))
+                if speed == 0.0 and name not in self.speeds:
+                    continue
+                if name not in self.speeds:
+                    self.accumulators[name] = 0.0
+                self.speeds[name] = speed
+            if self.thread is None and len(self.speeds) > 0:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify()
+
+    def tick(self):
+        with self.arm.lock, self.cond:
+            changes = {}
+            for name, speed in list(self.speeds.items()):
+                if speed == 0.0:
+                    changes[name] = 0
+                    del self.speeds[name]
+                    del self.accumulators[name]
+                    continue
+                acc = self.accumulators[name] + abs(speed)
+                if acc >= 1.0:
+                    acc = acc - 1.0
+                    changes[name] = 1 if speed > 0 else 2
+                else:
+                    changes[name] = 0
+                self.accumulators[name] = acc
+            if len(changes) > 0:
+                self.arm.apply(changes)
+
+    def clear(self):
+        '''
+        Forgets all speeds without stopping the joints, the caller stops
+        them while holding the lock of the arm.
+        '''
+        with self.cond:
+            self.speeds = {}
+            self.accumulators = {}
+
+    def run(self):
+        deadline = None
+        while True:
+            with self.cond:
+                while len(self.speeds) == 0 and self.running is True:
+                    deadline = None
+                    self.cond.wait()
+                if self.running is False:
+                    return
+            now = self.clock()
+            if deadline is None:
+                deadline = now
+            elif deadline > now:
+                self.sleep((deadline - now) / 1e9)
+                now = self.clock()
+            jitter = now - deadline
+            if jitter >= self.period:
+                missed = jitter // self.period
+                self.num_skipped = self.num_skipped + missed
+                deadline = deadline + missed * self.period
+                jitter = now - deadline
+            self.num_ticks = self.num_ticks + 1
+            self.sum_jitter = self.sum_jitter + jitter
+            if jitter > self.max_jitter:
+                self.max_jitter = jitter
+            if jitter > self.jitter_bound:
+                self.num_overruns = self.num_overruns + 1
+            metrics.PWM_TICK_JITTER_SECONDS.observe(jitter / 1e9)
+            try:
+                self.tick()
+            except Exception:
+                # the state is sent again with the next tick
+                logging.exception('PwmEngine: tick failed')
+            deadline = deadline + self.period
+
+    def get_max_jitter(self):
+        return self.max_jitter
+
+    def get_mean_jitter(self):
+        if self.num_ticks == 0:
+            return 0.0
+        return float(self.sum_jitter) / self.num_ticks
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            stopped = dict((name, 0) for name in self.speeds)
+            self.speeds = {}
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+        if len(stopped) > 0:
+            self.arm.apply(stopped)
+
+
+class PoseTracker():
+    '''
+    Estimates the pose of an arm by dead reckoning. The offset of every
+    joint is its signed run time in seconds, positive for state 1 (up,
+    clockwise or close), since the tracker was reset. Every sent state adds
+    the run time since the previous one to the joints which were moving, a
+    constant amount of work per move.
+    '''
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.joints = [(name, cls.shift) for name, cls in COMPONENTS
+                       if cls.reversible is True]
+        self.offsets = dict((name, 0.0) for name, shift in self.joints)
+        self.state = 0
+        self.since = self.clock()
+
+    def update(self, state):
+        now = self.clock()
+        elapsed = now - self.since
+        for name, shift in self.joints:
+            s = (self.state >> shift) & 3
+            if s == 1:
+                self.offsets[name] = self.offsets[name] + elapsed
+            elif s == 2:
+                self.offsets[name] = self.offsets[name] - elapsed
+        self.state = state
+        self.since = now
+
+    def get_offsets(self):
+        '''
+        Returns the current offset of every joint, including the run time of
+        the joints moving now.
+        '''
+        self.update(self.state)
+        return dict(self.offsets)
+
+    def reset(self):
+        self.update(self.state)
+        for name in self.offsets:
+            self.offsets[name] = 0.0
+
+
+class StateFeed():
+    '''
+    Publishes every packed state sent to the arm together with an increasing
+    version number to any number of waiting readers.
+    '''
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.version = 0
+        self.state = 0
+        self.listeners = []
+
+    def add_listener(self, callback):
+        '''
+        Calls callback with the version and the state after every publish,
+        on the publishing thread.
+        '''
+        self.listeners.append(callback)
+
+    def publish(self, state):
+        with self.cond:
+            self.version = self.version + 1
+            self.state = state
+            version = self.version
+            self.cond.notify_all()
+        for callback in self.listeners:
+            callback(version, state)
+
+    def get(self):
+        with self.cond:
+            return self.version, self.state
+
+    def wait(self, version, timeout=None):
+        '''
+        Waits until the version differs from the given one and returns the
+        current version and state, which are unchanged after a timeout.
+        '''
+        with self.cond:
+            if self.version == version:
+                self.cond.wait(timeout)
+            return self.version, self.state
+
+
+def state_texts(state):
+    '''
+    Returns the state number and text of every component of a packed state.
+    '''
+    texts = {}
+    for name, cls in COMPONENTS:
+        c = cls()
+        c.packed.value = state
+        texts[name] = {'result': c.state, 'result_text': c.get_state_text()}
+    return texts
+
+
+def find_device(usb_vendor=0x1267, usb_product=0x0000, backend=None):
+    '''
+    Returns the device of the given backend, 'usb' for the arm attached by
+    USB or 'simulated' for a SimulatedArm. By default the backend is taken
+    from the environment variable ROBOTIC_ARM_BACKEND, else it is 'usb'.
+    '''
+    if backend is None:
+        backend = os.environ.get('ROBOTIC_ARM_BACKEND', 'usb')
+    if backend == 'usb':
+        return usb.core.find(idVendor=usb_vendor, idProduct=usb_product)
+    if backend == 'simulated':
+        import simulator
+        return simulator.SimulatedArm()
+    raise ValueError('Unknown backend: %s' % backend)
+
+
+def find_arms(usb_vendor=0x1267, usb_product=0x0000, backend=None):
+    if backend is None:
+        backend = os.environ.get('ROBOTIC_ARM_BACKEND', 'usb')
+    if backend != 'usb':
+        return [find_device(usb_vendor, usb_product, backend)]
+    return list(usb.core.find(find_all=True, idVendor=usb_vendor,
+                              idProduct=usb_product))
+
+
 class RoboticArm():
 
-    def __init__(self, usb_vendor=0x1267, usb_product=0x0000, recorder=None):
-        self.usb_arm = usb.core.find(idVendor=usb_vendor,
-                                     idProduct=usb_product)
+    def __init__(self, usb_vendor=0x1267, usb_product=0x0000, recorder=None,
+                 async_writer=False, min_interval=0.0, usb_arm=None,
+                 backend=None):
+        if usb_arm is None:
+            usb_arm = find_device(usb_vendor, usb_product, backend)
+        self.usb_arm = usb_arm
         if self.usb_arm is None:
             raise ValueError("'Arm not found")
 
-        self.base = Base()
-        self.shoulder = Shoulder()
-        self.elbow = Elbow()
-        self.wrist = Wrist()
-        self.gripper = Gripper()
-        self.light = Light()
+        self.writer = None
+        if async_writer is True:
+            self.writer = UsbWriter(self.usb_arm, min_interval)
+        self.last_future = None
+        self.lock = threading.RLock()
+        self.timer = TimerWheel(self.expire)
+        self.timed_moves = {}
+        self.feed = StateFeed()
+        self.pose = PoseTracker()
+        self.pwm = None
+
+        self.packed = PackedState()
+        self.base = Base(self.packed)
+        self.shoulder = Shoulder(self.packed)
+        self.elbow = Elbow(self.packed)
+        self.wrist = Wrist(self.packed)
+        self.gripper = Gripper(self.packed)
+        self.light = Light(self.packed)
 
         self.recorder = recorder
 
-        self.last_move = [0, 0, 0]
+        self.last_state = 0
+        self.last_move = MOVE_TABLE[0]
 
     def move_changed(self, current_move):
         if (current_move[0] == self.last_move[0]
@@ -180,52 +728,164 @@ class RoboticArm():
             return False
         return True
 
+    def transfer(self, cmd):
+        if self.writer is not None:
+            self.last_future = self.writer.publish(cmd)
+            return self.last_future
+        send(self.usb_arm, cmd)
+
+    def close(self):
+        if self.pwm is not None:
+            self.pwm.close()
+            self.pwm = None
+        self.timer.close()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
     def move(self, run_4_time=None):
-        a = 0
-        b = 0
-        l = 0
-        a = a + self.shoulder.compute_move()
-        a = a + self.elbow.compute_move()
-        a = a + self.wrist.compute_move()
-        a = a + self.gripper.compute_move()
-        b = b + self.base.compute_move()
-        l = l + self.light.compute_move()
-        cmd = [a, b, l]
-        if self.move_changed(cmd) is True:
-            self.usb_arm.ctrl_transfer(0x40, 6, 0x100, 0, cmd, 1000)
+        '''
+        Sends the state of the components to the arm, if it changed. With the
+        asynchronous writer it returns a future for the transfer of this
+        state.
+        '''
+        with self.lock:
+            moved = self.packed.value != self.last_state
+            future = self._move()
+        if run_4_time is None or moved is False:
+            return future
+        # the lock is released while sleeping, so other threads can still
+        # move the arm, the stop clears all components like before
+        time.sleep(run_4_time)
+        with self.lock:
+            self.packed.value = 0
+            return self._move()
+
+    def _move(self):
+        state = self.packed.value
+        if state != self.last_state:
+            cmd = MOVE_TABLE[state]
+            self.transfer(cmd)
+            self.pose.update(state)
+            self.last_state = state
             self.last_move = cmd
+            self.feed.publish(state)
 
             if self.recorder is not None:
-                a = 0
-                b = 0
-                l = 0
-                a = a + self.shoulder.compute_move_reverse()
-                a = a + self.elbow.compute_move_reverse()
-                a = a + self.wrist.compute_move_reverse()
-                a = a + self.gripper.compute_move_reverse()
-                b = b + self.base.compute_move_reverse()
-                l = l + self.light.compute_move()
-                self.recorder.add_move_cmd(cmd, [a, b, l])
-
-            if run_4_time is not None:
-                time.sleep(run_4_time)
-                self.base.set_stop()
-                self.shoulder.set_stop()
-                self.elbow.set_stop()
-                self.wrist.set_stop()
-                self.gripper.set_stop()
-                self.light.set_off()
-                self.usb_arm.ctrl_transfer(0x40, 6, 0x100, 0, [0, 0, 0], 1000)
-                self.last_move = [0, 0, 0]
-
-                if self.recorder is not None:
-                    self.recorder.add_move_cmd([0, 0, 0], [0, 0, 0])
+                self.recorder.add_move_cmd(cmd, MOVE_REVERSE_TABLE[state])
+        else:
+            metrics.MOVES_SKIPPED.inc()
+        return self.last_future
+
+    def apply(self, changes):
+        '''
+        Changes the states of several components at once, for example
+        {'shoulder': 'up', 'base': 'stop'}, and moves the arm with a single
+        transfer. States are given by name or by number.
+        '''
+        with self.lock:
+            value = self.packed.value
+            for name, state in changes.items():
+                value = self.apply_state(value, name, state)
+            self.packed.value = value
+            return self._move()
+
+    def apply_state(self, value, name, state):
+        if name not in COMPONENT_NAMES:
+            raise ValueError('Unknown component: %s' % name)
+        c = getattr(self, name)
+        if isinstance(state, str) and state in c.states:
+            s = c.states[state]
+        elif (isinstance(state, int) and not isinstance(state, bool)
+              and state in c.states.values()):
+            s = state
+        else:
+            raise ValueError('Unknown state of %s: %s' % (name, state))
+        return (value & ~(3 << c.shift)) | (s << c.shift)
+
+    def move_for(self, seconds, components=None):
+        '''
+        Moves the arm and returns immediately with a TimedMove handle. After
+        seconds the given components, by default all moving ones, are
+        stopped, unless their state was changed in the meantime.
+        '''
+        with self.lock:
+            if components is None:
+                components = [name for name in COMPONENT_NAMES
+                              if getattr(self, name).state != 0]
+            states = {}
+            for name in components:
+                states[name] = getattr(self, name).state
+                previous = self.timed_moves.get(name)
+                if previous is not None:
+                    previous.states.pop(name, None)
+            handle = TimedMove(states)
+            for name in components:
+                self.timed_moves[name] = handle
+            self._move()
+        return self.timer.schedule(seconds, handle)
+
+    def expire(self, handles):
+        with self.lock:
+            value = self.packed.value
+            for handle in handles:
+                for name, state in handle.states.items():
+                    if getattr(self, name).state == state:
+                        value = self.apply_state(value, name, 0)
+                    if self.timed_moves.get(name) is handle:
+                        del self.timed_moves[name]
+            self.packed.value = value
+            try:
+                self._move()
+            except Exception as e:
+                for handle in handles:
+                    handle.error = e
+                raise
+            finally:
+                for handle in handles:
+                    handle.done.set()
+
+    def go_home(self, wait=True, min_offset=0.01):
+        '''
+        Drives all joints back to the pose at the last reset of the pose
+        tracker at the same time, every joint for its own offset, so it
+        takes as long as the largest offset. Returns the TimedMove handles,
+        by default after they expired.
+        '''
+        with self.lock:
+            if self.pwm is not None:
+                self.pwm.clear()
+            offsets = self.pose.get_offsets()
+            value = self.packed.value
+            for name, offset in offsets.items():
+                state = 0
+                if offset >= min_offset:
+                    state = 2
+                elif offset <= -min_offset:
+                    state = 1
+                value = self.apply_state(value, name, state)
+            self.packed.value = value
+            handles = [self.move_for(abs(offset), [name])
+                       for name, offset in offsets.items()
+                       if abs(offset) >= min_offset]
+        if wait is True:
+            for handle in handles:
+                handle.wait()
+        return handles
+
+    def set_speeds(self, speeds):
+        '''
+        Moves joints with a proportional speed between -1.0 and 1.0, see
+        PwmEngine. A speed of 0.0 stops the joint and hands it back to the
+        other methods.
+        '''
+        if self.pwm is None:
+            self.pwm = PwmEngine(self)
+        self.pwm.set_speeds(speeds)
 
     def stop(self):
-        self.base.set_stop()
-        self.shoulder.set_stop()
-        self.elbow.set_stop()
-        self.wrist.set_stop()
-        self.gripper.set_stop()
-        self.light.set_off()
-        self.move()
+        with self.lock:
+            if self.pwm is not None:
+                self.pwm.clear()
+            self.packed.value = 0
+            return self._move()
@@ -0,0 +1,306 @@
+# MIT License
+#
+# Copyright (c) 2015-2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Benchmarks for the library. All of them run against fake devices and
+synthetic frames and print their results as JSON, which can be compared
+across commits.
+'''
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from arm import RoboticArm, MOVE_TABLE, MOVE_REVERSE_TABLE
+from recorder import MoveCmd, Program, Player, Recorder
+from simulator import SimulatedArm
+
+try:
+    import numpy
+    import camera
+except ImportError:
+    camera = None
+
+
+class NullDevice():
+    '''
+    A device which accepts every transfer at once, to measure the overhead
+    of the library alone.
+    '''
+
+    def ctrl_transfer(self, *args):
+        return 3
+
+
+def percentiles(values, points=(50, 90, 99)):
+    values = sorted(values)
+    result = {}
+    for p in points:
+        result['p%d' % p] = values[min(len(values) - 1,
+                                        len(values) * p // 100)]
+    result['min'] = values[0]
+    result['max'] = values[-1]
+    result['mean'] = float(sum(values)) / len(values)
+    return result
+
+
+def time_calls(call, number, repeat=5):
+    '''
+    Returns the nanoseconds per call of the fastest and the median of repeat
+    runs of number calls.
+    '''
+    runs = []
+    for r in range(repeat):
+        start = time.perf_counter_ns()
+        for i in range(number):
+            call(i)
+        runs.append(float(time.perf_counter_ns() - start) / number)
+    runs.sort()
+    return {'best_ns': runs[0], 'median_ns': runs[len(runs) // 2]}
+
+
+def measure_memory(build):
+    tracemalloc.start()
+    program = build()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return program, size
+
+
+def bench_memory(num_steps):
+    def build_list():
+        program = []
+        for i in range(num_steps):
+            program.append(MoveCmd(0.01, [i % 256, 1, 0], [i % 256, 2, 0]))
+        return program
+
+    def build_program():
+        program = Program()
+        for i in range(num_steps):
+            program.append_step(0.01, [i % 256, 1, 0], [i % 256, 2, 0])
+        return program
+
+    results = []
+    for name, build in [('list of MoveCmd', build_list),
+                        ('Program', build_program)]:
+        program, size = measure_memory(build)
+        results.append((name, size))
+        del program
+    return results
+
+
+def bench_calls(number):
+    '''
+    The overhead of the calls made for every move of the arm.
+    '''
+    robotic_arm = RoboticArm(usb_arm=NullDevice())
+    recorder = Recorder(NullDevice())
+    recorder.start_record()
+
+    def move_changed(i):
+        robotic_arm.move_changed(MOVE_TABLE[i & 0xfff])
+
+    def move_unchanged(i):
+        robotic_arm.move()
+
+    def move(i):
+        robotic_arm.packed.value = i & 0xfff
+        robotic_arm.move()
+
+    def apply(i):
+        robotic_arm.apply({'shoulder': i & 1, 'base': 2})
+
+    def add_move_cmd(i):
+        recorder.add_move_cmd(MOVE_TABLE[i & 0xfff],
+                              MOVE_REVERSE_TABLE[i & 0xfff])
+
+    results = {}
+    for name, call in [('move_changed', move_changed),
+                       ('move_unchanged', move_unchanged),
+                       ('move', move), ('apply', apply),
+                       ('add_move_cmd', add_move_cmd)]:
+        if name == 'add_move_cmd':
+            recorder.clear_record()
+            recorder.start_record()
+        results[name] = time_calls(call, number)
+    robotic_arm.close()
+    return results
+
+
+def build_program(num_steps):
+    program = Program()
+    for i in range(num_steps):
+        state = (i * 37) & 0xfff
+        program.append_step(0.01, MOVE_TABLE[state], MOVE_REVERSE_TABLE[state])
+    return program
+
+
+def bench_files(sizes):
+    '''
+    The seconds to save and open programs of the given numbers of steps as
+    text and binary files, and the sizes of the files.
+    '''
+    directory = tempfile.mkdtemp()
+    results = {}
+    try:
+        for num_steps in sizes:
+            recorder = Recorder(NullDevice())
+            recorder.program = build_program(num_steps)
+            result = {}
+            for kind, save in [('text', recorder.save),
+                               ('binary', recorder.save_binary)]:
+                path = os.path.join(directory, 'program.' + kind)
+                start = time.perf_counter()
+                save(path)
+                result[kind + '_save_s'] = time.perf_counter() - start
+                result[kind + '_bytes'] = os.path.getsize(path)
+                reader = Recorder(NullDevice())
+                start = time.perf_counter()
+                reader.open(path)
+                result[kind + '_open_s'] = time.perf_counter() - start
+                start = time.perf_counter()
+                for step in reader.program:
+                    pass
+                result[kind + '_iterate_s'] = time.perf_counter() - start
+                if hasattr(reader.program, 'close'):
+                    reader.program.close()
+                os.remove(path)
+            results[str(num_steps)] = result
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def bench_playback(num_steps, timespan, latency):
+    '''
+    The distribution of the deadline jitter of a played program in
+    microseconds, with a simulated arm which takes latency seconds per
+    transfer.
+    '''
+    player = Player(SimulatedArm(latency=latency))
+    steps = [(timespan, MOVE_TABLE[(i * 37) & 0xfff])
+             for i in range(num_steps)]
+    report = player.run(steps)
+    return {'jitter_us': percentiles([j / 1e3 for j in report.get_jitter()]),
+            'latency_us': percentiles([l / 1e3
+                                       for l in report.get_latency()])}
+
+
+def bench_encode(width, height, number):
+    '''
+    The frames per second of the JPEG encoding of synthetic frames, at full
+    size and scaled down to a width of 320 pixels.
+    '''
+    if camera is None:
+        return {'skipped': 'numpy or OpenCV is not installed'}
+    random = numpy.random.RandomState(0)
+    y, x = numpy.mgrid[0:height, 0:width]
+    gradient = numpy.dstack([x * 255 // width, y * 255 // height,
+                             (x + y) * 255 // (width + height)])
+    frames = [numpy.clip(gradient + random.randint(-8, 8, gradient.shape),
+                         0, 255).astype(numpy.uint8) for i in range(8)]
+    results = {}
+    for name, scaled_width in [('full', None), ('320', 320)]:
+        start = time.perf_counter()
+        size = 0
+        for i in range(number):
+            size = size + len(camera.encode(frames[i % len(frames)],
+                                            scaled_width))
+        seconds = time.perf_counter() - start
+        results[name] = {'fps': number / seconds,
+                         'mean_bytes': size // number}
+    return results
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+BENCHMARKS = ['memory', 'calls', 'files', 'playback', 'encode']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmarks for the Robotic Arm library.')
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help='The benchmarks to run, by default all of: '
+                        + ', '.join(BENCHMARKS))
+    parser.add_argument('-n', '--steps', type=int, default=1000000,
+                        help='The number of steps of the memory benchmark.')
+    parser.add_argument('-c', '--calls', type=int, default=100000,
+                        help='The number of calls per timing run.')
+    parser.add_argument('-m', '--max-exponent', type=int, default=6,
+                        help='The file benchmark uses programs of 10^3 up to '
+                        '10^max-exponent steps.')
+    parser.add_argument('-p', '--playback-steps', type=int, default=1000,
+                        help='The number of steps of the played program.')
+    parser.add_argument('-t', '--timespan', type=float, default=0.002,
+                        help='The seconds between the played steps.')
+    parser.add_argument('-l', '--latency', type=float, default=0.0005,
+                        help='The seconds a simulated transfer takes.')
+    parser.add_argument('-f', '--frames', type=int, default=200,
+                        help='The number of encoded frames.')
+    parser.add_argument('-o', '--output',
+                        help='Write the JSON to this file.')
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: %s' % name)
+    if len(args.benchmarks) == 0:
+        args.benchmarks = BENCHMARKS
+
+    results = {}
+    if 'memory' in args.benchmarks:
+        results['memory'] = dict(
+            (name, {'bytes': size, 'bytes_per_step': float(size) / args.steps})
+            for name, size in bench_memory(args.steps))
+    if 'calls' in args.benchmarks:
+        results['calls'] = bench_calls(args.calls)
+    if 'files' in args.benchmarks:
+        results['files'] = bench_files(
+            [10 ** e for e in range(3, args.max_exponent + 1)])
+    if 'playback' in args.benchmarks:
+        results['playback'] = bench_playback(args.playback_steps,
+                                             args.timespan, args.latency)
+    if 'encode' in args.benchmarks:
+        results['encode'] = bench_encode(640, 480, args.frames)
+    output = {'commit': get_commit(),
+              'python': platform.python_version(),
+              'machine': platform.machine(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'results': results}
+    text = json.dumps(output, indent=2, sort_keys=True)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
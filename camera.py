@@ -25,6 +25,31 @@ Optional video feed for web.py
 '''
 
 import cv2
+import logging
+import numpy as np
+import threading
+import time
+import metrics
+import recorder
+
+
+# the JPEG quality used when no other is requested, the default of OpenCV
+DEFAULT_QUALITY = 95
+
+
+def encode(image, width=None, quality=DEFAULT_QUALITY):
+    '''
+    Encodes an image as JPEG, scaled down to width if it is wider.
+    '''
+    start = time.perf_counter()
+    if width is not None and width < image.shape[1]:
+        height = max(1, image.shape[0] * width // image.shape[1])
+        image = cv2.resize(image, (width, height),
+                           interpolation=cv2.INTER_AREA)
+    ret, jpeg = cv2.imencode('.jpg', image,
+                             [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+    metrics.CAMERA_ENCODE_SECONDS.observe(time.perf_counter() - start)
+    return jpeg.tobytes()
 
 
 class CameraStream(object):
@@ -34,7 +59,416 @@ class CameraStream(object):
     def __del__(self):
         self.video.release()
 
-    def get_frame(self):
+    def get_image(self):
         success, image = self.video.read()
-        ret, jpeg = cv2.imencode('.jpg', image)
-        return jpeg.tostring()
+        if success is False:
+            raise IOError('Could not read from the camera')
+        return image
+
+    def get_frame(self):
+        return encode(self.get_image())
+
+
+class ChangeDetector(object):
+    '''
+    Decides if an image differs from the last accepted one by the mean
+    absolute difference of their pixels on a grid of every step-th pixel.
+    Every keyframe_interval-th image is accepted regardless.
+    '''
+
+    def __init__(self, sensitivity=4.0, keyframe_interval=30, step=4):
+        self.sensitivity = sensitivity
+        self.keyframe_interval = keyframe_interval
+        self.step = step
+        self.reference = None
+        self.since_keyframe = 0
+
+    def changed(self, image):
+        sample = image[::self.step, ::self.step].astype(np.int16)
+        self.since_keyframe = self.since_keyframe + 1
+        if (self.reference is None
+                or self.reference.shape != sample.shape
+                or self.since_keyframe >= self.keyframe_interval
+                or np.abs(sample - self.reference).mean()
+                >= self.sensitivity):
+            self.reference = sample
+            self.since_keyframe = 0
+            return True
+        return False
+
+
+class FrameRing(object):
+    '''
+    Keeps the latest images of a camera in one array allocated with the
+    first image, as many as fit into max_bytes, together with their capture
+    times on recorder.clock. The slots are only written and read while
+    holding the lock, so an exported image is never overwritten halfway.
+    The images are read into a pool of publish buffers allocated at the same
+    time, which are reference counted with hold() and release().
+    '''
+
+    def __init__(self, max_bytes, buffers=4):
+        self.max_bytes = max_bytes
+        self.buffers = buffers
+        self.frames = None
+        self.times = None
+        self.pool = []
+        self.refs = []
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def allocate(self, image):
+        capacity = max(1, self.max_bytes // image.nbytes)
+        self.frames = np.empty((capacity,) + image.shape, image.dtype)
+        self.times = np.zeros(capacity, np.float64)
+        self.pool = [np.empty_like(image) for i in range(self.buffers)]
+        self.refs = [0] * self.buffers
+
+    def find(self, image):
+        for i, buf in enumerate(self.pool):
+            if buf is image:
+                return i
+        return None
+
+    def hold(self, image):
+        '''
+        Adds a reference to image if it is a publish buffer.
+        '''
+        with self.lock:
+            i = self.find(image)
+            if i is not None:
+                self.refs[i] = self.refs[i] + 1
+
+    def release(self, image):
+        '''
+        Drops a reference to image, a publish buffer without references is
+        reused for the next image.
+        '''
+        with self.lock:
+            i = self.find(image)
+            if i is not None:
+                self.refs[i] = self.refs[i] - 1
+
+    def read(self, video):
+        '''
+        Reads the next image of video into a free publish buffer, copies it
+        into the ring and returns it with one reference held. The returned
+        image is not part of the ring, so it can be published while the ring
+        moves on. Only while every buffer is still referenced, a new image
+        is allocated, which is not counted.
+        '''
+        buf = None
+        with self.lock:
+            if 0 in self.refs:
+                i = self.refs.index(0)
+                self.refs[i] = 1
+                buf = self.pool[i]
+        if buf is not None:
+            success, image = video.read(buf)
+        else:
+            success, image = video.read()
+        if success is False or image is not buf:
+            self.release(buf)
+        if success is False:
+            raise IOError('Could not read from the camera')
+        with self.lock:
+            if self.frames is None:
+                self.allocate(image)
+            slot = self.count % len(self.frames)
+            if image.shape != self.frames[slot].shape:
+                raise IOError('The size of the camera images changed')
+            np.copyto(self.frames[slot], image)
+            self.times[slot] = recorder.clock()
+            self.count = self.count + 1
+        return image
+
+    def window(self, c0, c1):
+        '''
+        Returns the slots and capture times of the images captured between
+        the clock values c0 and c1 in the order they were captured.
+        '''
+        with self.lock:
+            n = min(self.count, 0 if self.frames is None else len(self.frames))
+            first = self.count - n
+            slots = [(i % len(self.frames), self.times[i % len(self.frames)])
+                     for i in range(first, self.count)]
+        return [(i, t) for i, t in slots if c0 <= t <= c1]
+
+    def copy(self, slot, t, out):
+        '''
+        Copies the image of slot into out and returns True, unless the image
+        captured at t was overwritten in the meantime.
+        '''
+        with self.lock:
+            if self.times[slot] != t:
+                return False
+            np.copyto(out, self.frames[slot])
+            return True
+
+    def export(self, path, c0, c1, rec=None, fps=None):
+        '''
+        Writes the images captured between the clock values c0 and c1 to the
+        video path.avi and their times relative to c0 to path.times. With a
+        recorder the program steps of the same time window are written to
+        path.txt, so the clip and the program both start at c0. Images
+        overwritten by the capture during the export are left out. Returns
+        the number of exported images. A recorder without recorded clock
+        times raises ValueError before any file is written.
+        '''
+        program = None
+        if rec is not None:
+            program = rec.get_slice(c0, c1)
+        window = self.window(c0, c1)
+        times = []
+        if len(window) > 0:
+            if fps is None:
+                fps = 10.0
+                if len(window) > 1 and window[-1][1] > window[0][1]:
+                    fps = (len(window) - 1) / (window[-1][1] - window[0][1])
+            image = np.empty(self.frames.shape[1:], self.frames.dtype)
+            height, width = image.shape[0:2]
+            writer = cv2.VideoWriter(path + '.avi',
+                                     cv2.VideoWriter_fourcc(*'MJPG'),
+                                     fps, (width, height))
+            for slot, t in window:
+                if self.copy(slot, t, image) is True:
+                    writer.write(image)
+                    times.append(t - c0)
+            writer.release()
+        f = open(path + '.times', 'w')
+        for t in times:
+            f.write('%f\n' % t)
+        f.close()
+        if program is not None:
+            recorder.write_text_program(path + '.txt', program)
+        return len(times)
+
+
+class SharedCamera(object):
+    '''
+    Captures the images of one camera on a single thread while at least one
+    viewer is connected. The latest image is published in a slot together
+    with a sequence number, which all viewers share. Every image is encoded
+    at most once per profile, a (width, quality) pair, and the encoded
+    frames are shared by all viewers of the profile. With a ChangeDetector
+    images which did not change are not published at all. Instead of a
+    camera any source with the read() method of cv2.VideoCapture can be
+    used. With a FrameRing all captured images are also kept in the ring, and
+    the published images are its publish buffers: the camera holds the
+    latest one and wait_image() holds the returned one until release().
+    '''
+
+    def __init__(self, camera_number, detector=None, source=None, ring=None):
+        self.camera_number = camera_number
+        self.detector = detector
+        self.source = source
+        self.ring = ring
+        self.stats = {'captured': 0, 'published': 0, 'skipped': 0,
+                      'skipped_deliveries': 0, 'encodes': 0,
+                      'encode_seconds': 0.0, 'delivered': 0,
+                      'delivered_bytes': 0}
+        self.cond = threading.Condition()
+        self.viewers = 0
+        self.seq = 0
+        self.image = None
+        self.encoded = {}
+        self.listeners = []
+        self.thread = None
+
+    def add_listener(self, callback):
+        '''
+        Calls callback with the sequence number of every published image, on
+        the capture thread.
+        '''
+        self.listeners.append(callback)
+
+    def open(self):
+        with self.cond:
+            self.viewers = self.viewers + 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def close(self):
+        with self.cond:
+            self.viewers = self.viewers - 1
+
+    def run(self):
+        video = self.source
+        if video is None:
+            video = cv2.VideoCapture(self.camera_number)
+        while True:
+            with self.cond:
+                if self.viewers == 0:
+                    if self.source is None:
+                        video.release()
+                    self.thread = None
+                    return
+            try:
+                if self.ring is not None:
+                    image = self.ring.read(video)
+                else:
+                    success, image = video.read()
+                    if success is False:
+                        raise IOError('Could not read from the camera')
+            except Exception:
+                logging.exception('Camera %s: capture failed',
+                                  self.camera_number)
+                time.sleep(0.1)
+                continue
+            self.publish(image)
+
+    def release(self, image):
+        '''
+        Drops the reference to an image returned by wait_image().
+        '''
+        if self.ring is not None and image is not None:
+            self.ring.release(image)
+
+    def publish(self, image):
+        self.stats['captured'] = self.stats['captured'] + 1
+        if self.detector is not None and not self.detector.changed(image):
+            with self.cond:
+                self.stats['skipped'] = self.stats['skipped'] + 1
+                self.stats['skipped_deliveries'] = (
+                    self.stats['skipped_deliveries'] + self.viewers)
+            metrics.CAMERA_FRAMES_SKIPPED.inc()
+            self.release(image)
+            return
+        with self.cond:
+            self.stats['published'] = self.stats['published'] + 1
+            self.seq = self.seq + 1
+            previous = self.image
+            self.image = image
+            self.encoded = dict((k, v) for k, v in self.encoded.items()
+                                if k[0] == self.seq - 1)
+            seq = self.seq
+            self.cond.notify_all()
+        self.release(previous)
+        for callback in self.listeners:
+            callback(seq)
+
+    def wait_image(self, seq, timeout=1.0):
+        '''
+        Waits for an image with a sequence number other than seq and returns
+        the sequence number and the image, which has to be given to release()
+        once it is encoded.
+        '''
+        with self.cond:
+            if self.seq == seq:
+                self.cond.wait(timeout)
+            if self.ring is not None and self.image is not None:
+                self.ring.hold(self.image)
+            return self.seq, self.image
+
+    def get_cached(self, seq, width=None, quality=DEFAULT_QUALITY):
+        '''
+        Returns the encoded frame if it is already available, without
+        waiting.
+        '''
+        with self.cond:
+            entry = self.encoded.get((seq, width, quality))
+        if entry is not None and entry[0].is_set():
+            return entry[1]
+        return None
+
+    def get_encoded(self, seq, image, width=None, quality=DEFAULT_QUALITY):
+        key = (seq, width, quality)
+        with self.cond:
+            entry = self.encoded.get(key)
+            owner = entry is None
+            if owner is True:
+                entry = [threading.Event(), None]
+                if seq >= self.seq - 1:
+                    self.encoded[key] = entry
+        if owner is True:
+            start = time.perf_counter()
+            try:
+                entry[1] = encode(image, width, quality)
+            finally:
+                entry[0].set()
+            with self.cond:
+                self.stats['encodes'] = self.stats['encodes'] + 1
+                self.stats['encode_seconds'] = (self.stats['encode_seconds']
+                                                + time.perf_counter() - start)
+        else:
+            entry[0].wait()
+        return entry[1]
+
+    def frames(self, width=None, quality=DEFAULT_QUALITY, max_fps=None):
+        '''
+        Yields the encoded frames for one viewer. The time until the viewer
+        asks for the next frame is the time the frame took to be written,
+        so a viewer whose connection backs up is sent fewer frames instead
+        of queueing them.
+        '''
+        min_interval = 0.0
+        if max_fps is not None and max_fps > 0:
+            min_interval = 1.0 / max_fps
+        write_time = 0.0
+        self.open()
+        try:
+            seq = 0
+            sent = 0.0
+            while True:
+                s, image = self.wait_image(seq)
+                if s == seq or image is None:
+                    self.release(image)
+                    continue
+                wait = sent + max(min_interval, 2 * write_time) - \
+                    time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                    self.release(image)
+                    s, image = self.wait_image(None)
+                seq = s
+                try:
+                    frame = self.get_encoded(s, image, width, quality)
+                finally:
+                    self.release(image)
+                sent = time.monotonic()
+                with self.cond:
+                    self.stats['delivered'] = self.stats['delivered'] + 1
+                    self.stats['delivered_bytes'] = (
+                        self.stats['delivered_bytes'] + len(frame))
+                yield frame
+                write_time = (write_time * 3 + time.monotonic() - sent) / 4
+        finally:
+            self.close()
+
+    def get_report(self):
+        '''
+        Returns the counters of the camera and an estimate of the encode
+        time and the bytes saved by skipping unchanged images, based on the
+        mean cost of the published ones.
+        '''
+        with self.cond:
+            report = dict(self.stats)
+        encode_seconds = 0.0
+        if report['published'] > 0:
+            encode_seconds = report['encode_seconds'] / report['published']
+        frame_bytes = 0.0
+        if report['delivered'] > 0:
+            frame_bytes = (float(report['delivered_bytes'])
+                           / report['delivered'])
+        report['encode_seconds_saved'] = report['skipped'] * encode_seconds
+        report['bytes_saved'] = report['skipped_deliveries'] * frame_bytes
+        return report
+
+
+shared_cameras = {}
+shared_cameras_lock = threading.Lock()
+
+
+def get_shared_camera(camera_number, detector=None, ring=None):
+    '''
+    Returns the shared camera of camera_number, the detector and the ring are
+    only used when it is created.
+    '''
+    with shared_cameras_lock:
+        camera = shared_cameras.get(camera_number)
+        if camera is None:
+            camera = SharedCamera(camera_number, detector, ring=ring)
+            shared_cameras[camera_number] = camera
+        return camera
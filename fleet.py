@@ -0,0 +1,153 @@
+# MIT License
+#
+# Copyright (c) 2015-2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+The library to control several arms connected to one host.
+'''
+
+from concurrent.futures import Future
+import queue
+import threading
+import time
+from arm import RoboticArm, find_arms
+from recorder import Recorder
+
+
+class ArmWorker():
+    '''
+    Owns one arm with its recorder and runs the jobs for it in order on its
+    own thread, so the arms of a fleet never wait for each other.
+    '''
+
+    def __init__(self, robotic_arm):
+        self.robotic_arm = robotic_arm
+        self.recorder = Recorder(usb_arm=robotic_arm.usb_arm)
+        self.robotic_arm.recorder = self.recorder
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, func, *args):
+        future = Future()
+        self.jobs.put((future, func, args))
+        return future
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            future, func, args = job
+            try:
+                result = func(*args)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
+        self.robotic_arm.close()
+
+
+class FleetReport():
+    '''
+    The JitterReports of a program played by every arm of a fleet.
+    '''
+
+    def __init__(self, reports):
+        self.reports = reports
+
+    def get_skew(self):
+        '''
+        Returns for every step the time in nanoseconds between the first and
+        the last arm finishing its transfer.
+        '''
+        skew = []
+        for done in zip(*[r.done for r in self.reports]):
+            skew.append(max(done) - min(done))
+        return skew
+
+    def get_start_skew(self):
+        skew = self.get_skew()
+        if len(skew) == 0:
+            return 0
+        return skew[0]
+
+    def get_max_skew(self):
+        skew = self.get_skew()
+        if len(skew) == 0:
+            return 0
+        return max(skew)
+
+
+class Fleet():
+    '''
+    All arms found on the bus, or the given devices, each with its own
+    worker thread and recorder.
+    '''
+
+    def __init__(self, usb_vendor=0x1267, usb_product=0x0000, devices=None):
+        if devices is None:
+            devices = find_arms(usb_vendor, usb_product)
+        if len(devices) == 0:
+            raise ValueError('No arm found')
+        self.workers = [ArmWorker(RoboticArm(usb_arm=d)) for d in devices]
+
+    def __len__(self):
+        return len(self.workers)
+
+    def get_arms(self):
+        return [w.robotic_arm for w in self.workers]
+
+    def apply(self, changes):
+        '''
+        Applies the changes to every arm in parallel and returns the futures
+        of the workers.
+        '''
+        return [w.submit(w.robotic_arm.apply, changes) for w in self.workers]
+
+    def stop(self):
+        return [w.submit(w.robotic_arm.stop) for w in self.workers]
+
+    def play(self, program, reverse=False, start_delay=0.1):
+        '''
+        Plays program on every arm, with the first step of all arms scheduled
+        at the same deadline start_delay seconds from now, and returns a
+        FleetReport.
+        '''
+        if reverse is True:
+            steps = [(mc.timespan, mc.move_cmd_reverse)
+                     for mc in reversed(program)]
+            steps.append((0.0, [0, 0, 0]))
+        else:
+            steps = [(mc.timespan, mc.move_cmd) for mc in program]
+        start = time.monotonic_ns() + int(start_delay * 1e9)
+        futures = [w.submit(w.recorder.player.run, steps, start)
+                   for w in self.workers]
+        return FleetReport([f.result() for f in futures])
+
+    def close(self):
+        for w in self.workers:
+            w.close()
@@ -36,105 +36,105 @@ class Robot(Gtk.Window):
     def _action_base_clockwise(self, widget, data=None):
         logging.debug('Init Clockwise Base')
         self.robotic_arm.base.set_clockwise()
-        self.robotic_arm.move(self.get_run_4())
+        self.move_component('base')
         logging.debug('Move Clockwise Base')
 
     def _action_base_anticlockwise(self, widget, data=None):
         logging.debug('Init AntiClockwise Base')
         self.robotic_arm.base.set_anticlockwise()
-        self.robotic_arm.move(self.get_run_4())
+        self.move_component('base')
         logging.debug('Move AntiClockwise Base')
 
     def _action_base_stop(self, widget, data=None):
         logging.debug('Init Stop Base')
         self.robotic_arm.base.set_stop()
-        self.robotic_arm.move(self.get_run_4())
+        self.move_component('base')
         logging.debug('Stoped Base')
 
     def _action_arm_up(self, widget, data=None):
         logging.debug('Init Shoulder Up')
         self.robotic_arm.shoulder.set_up()
-        self.robotic_arm.move(self.get_run_4())
+        self.move_component('shoulder')
         logging.debug('Move Shoulder Up')
 
     def _action_arm_down(self, widget, data=None):
         logging.debug('Init Shoulder Down')
         self.robotic_arm.shoulder.set_down()
-        self.robotic_arm.move(self.get_run_4())
+        self.move_component('shoulder')
         logging.debug('Move Shoulder Down')
 
     def _action_arm_stop(self, widget, data=None):
         logging.debug('Init Shoulder Stop')
         self.robotic_arm.shoulder.set_stop()
-        self.robotic_arm.move(self.get_run_4())
+        self.move_component('shoulder')
         logging.debug('Stoped Shoulder')
 
     def _action_elbow_up(self, widget, data=None):
         logging.debug('Init Elbow Up')
         self.robotic_arm.elbow.set_up()
-        self.robotic_arm.move(self.get_run_4())
+        self.move_component('elbow')
         logging.debug('Move Elbow Up')
 
     def _action_elbow_down(self, widget, data=None):
         logging.debug('Init Elbow Down')
         self.robotic_arm.elbow.set_down()
-        self.robotic_arm.move(self.get_run_4())
+        self.move_component('elbow')
         logging.debug('Move Elbow Down')
 
     def _action_elbow_stop(self, widget, data=None):
         logging.debug('Init Elbow Stop')
         self.robotic_arm.elbow.set_stop()
-        self.robotic_arm.move(self.get_run_4())
+        self.move_component('elbow')
         logging.debug('Stoped Elbow')
 
     def _action_wrist_up(self, widget, data=None):
         logging.debug('Init Wrist Up')
         self.robotic_arm.wrist.set_up()
-        self.robotic_arm.move(self.get_run_4())
+        self.move_component('wrist')
         logging.debug('Move Wrist Up')
 
     def _action_wrist_down(self, widget, data=None):
         logging.debug('Init Wrist Down')
         self.robotic_arm.wrist.set_down()
-        self.robotic_arm.move(self.get_run_4())
+        self.move_component('wrist')
         logging.debug('Move Wrist Down')
 
     def _action_wrist_stop(self, widget, data=None):
         logging.debug('Wrist Stop')
         self.robotic_arm.wrist.set_stop()
-        self.robotic_arm.move(self.get_run_4())
+        self.move_component('wrist')
         logging.debug('Stoped Wrist')
 
     def _action_gripper_open(self, widget, data=None):
         logging.debug('Init Gripper Open')
         self.robotic_arm.gripper.set_open()
-        self.robotic_arm.move(self.get_run_4())
+        self.move_component('gripper')
         logging.debug('Move Gripper Open')
 
     def _action_gripper_close(self, widget, data=None):
         logging.debug('Init Gripper Close')
         self.robotic_arm.gripper.set_close()
-        self.robotic_arm.move(self.get_run_4())
+        self.move_component('gripper')
         logging.debug('Move Gripper Close')
 
     def _action_gripper_stop(self, widget, data=None):
         logging.debug('Init Gripper Stop')
         self.robotic_arm.gripper.set_stop()
-        self.robotic_arm.move(self.get_run_4())
+        self.move_component('gripper')
         logging.debug('Stoped Gripper')
 
     def _action_led(self, widget, data=None):
         if(self.led.get_label() == 'Off'):
             self.led.set_label('On')
             self.robotic_arm.light.set_on()
-            self.robotic_arm.move(self.get_run_4())
+            self.move_component('light')
             logging.debug('light: On')
             return None
 
         if(self.led.get_label() == 'On'):
             self.led.set_label('Off')
             self.robotic_arm.light.set_off()
-            self.robotic_arm.move(self.get_run_4())
+            self.move_component('light')
             logging.debug('light: Off')
             return None
 
@@ -194,7 +194,10 @@ class Robot(Gtk.Window):
             self.file_path = dialog.get_filename()
             logging.debug('File selected: ' + self.file_path)
             self.file_label.set_text(os.path.basename(self.file_path))
-            self.robotic_arm.recorder.save(self.file_path)
+            if self.file_path.endswith('.bin'):
+                self.robotic_arm.recorder.save_binary(self.file_path)
+            else:
+                self.robotic_arm.recorder.save(self.file_path)
         elif response == Gtk.ResponseType.CANCEL:
             logging.debug('Cancel clicked')
         dialog.destroy()
@@ -227,6 +230,13 @@ class Robot(Gtk.Window):
         logging.debug('toggle run for sec')
         self.run_4_entry.set_editable(self.run_4_toggle.get_active())
 
+    def move_component(self, component):
+        t = self.get_run_4()
+        if t is None:
+            self.robotic_arm.move()
+        else:
+            self.robotic_arm.move_for(t, [component])
+
     def get_run_4(self):
         if self.run_4_toggle.get_active() is True:
             try:
@@ -245,6 +255,7 @@ class Robot(Gtk.Window):
     def destroy(self, widget, data=None):
         logging.debug('Init Stop')
         self.robotic_arm.stop()
+        self.robotic_arm.close()
         logging.debug('Stoped')
         Gtk.main_quit()
 
@@ -0,0 +1,117 @@
+# MIT License
+#
+# Copyright (c) 2015-2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+A load test for the web servers. It opens a number of video feed viewers and
+control clients against a running web.py or web_async.py and prints the
+frame rate, the request rate and the latency as JSON.
+'''
+
+import aiohttp
+import argparse
+import asyncio
+import json
+import time
+
+
+async def viewer(session, url, deadline, result):
+    frames = 0
+    try:
+        async with session.get(url + '/video_feed') as response:
+            async for chunk in response.content.iter_any():
+                frames = frames + chunk.count(b'--frame')
+                if time.monotonic() > deadline:
+                    break
+    except Exception:
+        result['viewer_errors'] = result['viewer_errors'] + 1
+    result['frames'].append(frames)
+
+
+async def control(session, url, deadline, result):
+    i = 0
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        try:
+            async with session.post(url + '/state',
+                                    json={'light': i % 2}) as response:
+                await response.read()
+                if response.status != 200:
+                    raise IOError(response.status)
+        except Exception:
+            result['control_errors'] = result['control_errors'] + 1
+            continue
+        result['latency'].append(time.monotonic() - start)
+        i = i + 1
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+async def run(url, viewers, controls, duration):
+    result = {'frames': [], 'latency': [], 'viewer_errors': 0,
+              'control_errors': 0}
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=duration + 30)
+    async with aiohttp.ClientSession(connector=connector,
+                                     timeout=timeout) as session:
+        deadline = time.monotonic() + duration
+        tasks = [viewer(session, url, deadline, result)
+                 for i in range(viewers)]
+        tasks.extend(control(session, url, deadline, result)
+                     for i in range(controls))
+        await asyncio.gather(*tasks)
+    fps = [float(f) / duration for f in result['frames']]
+    return {
+        'url': url,
+        'viewers': viewers,
+        'controls': controls,
+        'duration': duration,
+        'viewer_fps_mean': sum(fps) / len(fps) if len(fps) > 0 else None,
+        'viewer_fps_min': min(fps) if len(fps) > 0 else None,
+        'viewer_errors': result['viewer_errors'],
+        'control_requests_per_second':
+            len(result['latency']) / float(duration),
+        'control_latency_p50': percentile(result['latency'], 0.5),
+        'control_latency_p99': percentile(result['latency'], 0.99),
+        'control_errors': result['control_errors'],
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='A load test for the Robotic Arm web servers.')
+    parser.add_argument('-u', '--url', default='http://127.0.0.1:5000',
+                        help='The base url of the server.')
+    parser.add_argument('-v', '--viewers', type=int, nargs='+', default=[10],
+                        help='The numbers of concurrent video viewers.')
+    parser.add_argument('-c', '--controls', type=int, default=10,
+                        help='The number of concurrent control clients.')
+    parser.add_argument('-d', '--duration', type=float, default=10.0,
+                        help='The duration of every run in seconds.')
+    args = parser.parse_args()
+    for viewers in args.viewers:
+        print(json.dumps(asyncio.run(run(args.url, viewers, args.controls,
+                                         args.duration))))
@@ -0,0 +1,151 @@
+# MIT License
+#
+# Copyright (c) 2015-2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Counters and latency histograms of the library, rendered in the Prometheus
+text format.
+'''
+
+import bisect
+import errno
+import threading
+
+
+# the upper bounds in seconds of the buckets of the latency histograms
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0]
+
+
+class Counter():
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value = self.value + n
+
+    def render(self):
+        return ['# HELP %s %s' % (self.name, self.help),
+                '# TYPE %s counter' % self.name,
+                '%s %d' % (self.name, self.value)]
+
+
+class Histogram():
+    '''
+    A histogram with fixed buckets, an observation costs one bisect and one
+    increment.
+    '''
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] = self.counts[i] + 1
+            self.sum = self.sum + value
+
+    def render(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s histogram' % self.name]
+        n = 0
+        for bound, count in zip(self.buckets, counts):
+            n = n + count
+            lines.append('%s_bucket{le="%g"} %d' % (self.name, bound, n))
+        n = n + counts[-1]
+        lines.append('%s_bucket{le="+Inf"} %d' % (self.name, n))
+        lines.append('%s_sum %.9g' % (self.name, total))
+        lines.append('%s_count %d' % (self.name, n))
+        return lines
+
+
+class Registry():
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help):
+        c = Counter(name, help)
+        self.metrics.append(c)
+        return c
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        h = Histogram(name, help, buckets)
+        self.metrics.append(h)
+        return h
+
+    def render(self):
+        lines = []
+        for m in self.metrics:
+            lines.extend(m.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+USB_TRANSFER_SECONDS = REGISTRY.histogram(
+    'robotic_arm_usb_transfer_seconds',
+    'Duration of the USB transfers sent by RoboticArm.move.')
+PLAYBACK_TRANSFER_SECONDS = REGISTRY.histogram(
+    'robotic_arm_playback_transfer_seconds',
+    'Duration of the USB transfers sent by the Recorder playback.')
+USB_TRANSFER_TIMEOUTS = REGISTRY.counter(
+    'robotic_arm_usb_transfer_timeouts_total',
+    'Number of USB transfers which timed out.')
+USB_TRANSFER_ERRORS = REGISTRY.counter(
+    'robotic_arm_usb_transfer_errors_total',
+    'Number of USB transfers which failed for another reason.')
+MOVES_SKIPPED = REGISTRY.counter(
+    'robotic_arm_moves_skipped_total',
+    'Number of calls of RoboticArm.move without a state change.')
+RECORDER_APPENDS = REGISTRY.counter(
+    'robotic_arm_recorder_appends_total',
+    'Number of steps added to a recording.')
+CAMERA_ENCODE_SECONDS = REGISTRY.histogram(
+    'robotic_arm_camera_encode_seconds',
+    'Duration of the JPEG encoding of a camera frame.')
+
+CAMERA_FRAMES_SKIPPED = REGISTRY.counter(
+    'robotic_arm_camera_frames_skipped_total',
+    'Number of camera frames skipped because they did not change.')
+PWM_TICK_JITTER_SECONDS = REGISTRY.histogram(
+    'robotic_arm_pwm_tick_jitter_seconds',
+    'Delay of the ticks of the proportional speed engine.')
+
+
+def count_transfer_error(e):
+    if getattr(e, 'errno', None) == errno.ETIMEDOUT:
+        USB_TRANSFER_TIMEOUTS.inc()
+    else:
+        USB_TRANSFER_ERRORS.inc()
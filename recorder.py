@@ -25,8 +25,52 @@ The library to record sequences of movement of the arm and to play them
 forward and backward.
 '''
 
+from array import array
+import bisect
+import itertools
 import logging
+import mmap
+import os
+import queue
+import struct
+import sys
+import threading
 import time
+import metrics
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# the remaining wait before a deadline which is spent busy waiting instead of
+# sleeping, because sleep may overshoot by about a scheduler tick
+SPIN_NS = 2000000
+
+# binary programs start with a header holding a magic, the format version and
+# the number of steps, followed by one fixed width record per step holding
+# the timespan, the move command and the reversed move command
+BINARY_MAGIC = b'ARMP'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<4sHHQ')
+BINARY_RECORD = struct.Struct('<d6B')
+RECORD_DTYPE = None
+if np is not None:
+    RECORD_DTYPE = np.dtype([('timespan', '<f8'), ('cmds', 'u1', 6)])
+
+# the number of steps read at once when streaming a program file and the
+# default number of steps prefetched ahead of the playback
+STREAM_CHUNK = 256
+STREAM_WINDOW = 64
+
+# the clock of the recorded steps, which other recordings like camera frames
+# use to be aligned with them
+clock = time.monotonic
+
+# the byte and bit offset of the two state bits of every joint in a move
+# command
+JOINTS = [('shoulder', 0, 6), ('elbow', 0, 4), ('wrist', 0, 2),
+          ('gripper', 0, 0), ('base', 1, 0), ('light', 2, 0)]
 
 
 class MoveCmd():
@@ -37,84 +81,760 @@ class MoveCmd():
         self.move_cmd_reverse = move_cmd_reverse
 
 
+class Program():
+    '''
+    A program stored in columns, the timespans in an array of doubles and the
+    six command bytes of each step in a bytearray. Steps are returned as
+    MoveCmd objects when they are accessed. The end time of every step is
+    kept as prefix sum of the timespans.
+    '''
+
+    def __init__(self, steps=()):
+        self.timespans = array('d')
+        self.ends = array('d')
+        self.cmds = bytearray()
+        self.extend(steps)
+
+    def append_step(self, timespan, move_cmd, move_cmd_reverse):
+        self.timespans.append(timespan)
+        self.ends.append(self.get_runtime() + timespan)
+        self.cmds.extend(move_cmd)
+        self.cmds.extend(move_cmd_reverse)
+
+    def append(self, mc):
+        self.append_step(mc.timespan, mc.move_cmd, mc.move_cmd_reverse)
+
+    def extend(self, steps):
+        for mc in steps:
+            self.append(mc)
+
+    def set_timespan(self, i, timespan):
+        if i < 0:
+            i = i + len(self.timespans)
+        delta = timespan - self.timespans[i]
+        self.timespans[i] = timespan
+        for j in range(i, len(self.ends)):
+            self.ends[j] = self.ends[j] + delta
+
+    def get_end_times(self):
+        return self.ends
+
+    def get_runtime(self):
+        if len(self.ends) == 0:
+            return 0.0
+        return self.ends[-1]
+
+    def __len__(self):
+        return len(self.timespans)
+
+    def __getitem__(self, i):
+        timespan = self.timespans[i]
+        if i < 0:
+            i = i + len(self.timespans)
+        c = self.cmds[i * 6:i * 6 + 6]
+        return MoveCmd(timespan, [c[0], c[1], c[2]], [c[3], c[4], c[5]])
+
+    def __iter__(self):
+        for i in range(len(self.timespans)):
+            yield self[i]
+
+
+class JitterReport():
+    '''
+    The scheduled, sent and finished clock values of the transfers of a
+    played program. Without keep_samples only the summary is kept, so the
+    report does not grow with the program.
+    '''
+
+    def __init__(self, keep_samples=True):
+        self.keep_samples = keep_samples
+        self.scheduled = array('q')
+        self.sent = array('q')
+        self.done = array('q')
+        self.num_steps = 0
+        self.max_jitter = 0
+        self.sum_jitter = 0
+
+    def add(self, scheduled, sent, done):
+        if self.keep_samples is True:
+            self.scheduled.append(scheduled)
+            self.sent.append(sent)
+            self.done.append(done)
+        jitter = abs(done - scheduled)
+        self.num_steps = self.num_steps + 1
+        self.sum_jitter = self.sum_jitter + jitter
+        if jitter > self.max_jitter:
+            self.max_jitter = jitter
+
+    def get_num_steps(self):
+        return self.num_steps
+
+    def get_jitter(self):
+        '''
+        Returns for every step the time in nanoseconds by which the finished
+        transfer missed its deadline (negative if it was early).
+        '''
+        return [d - s for s, d in zip(self.scheduled, self.done)]
+
+    def get_latency(self):
+        return [d - s for s, d in zip(self.sent, self.done)]
+
+    def get_max_jitter(self):
+        return self.max_jitter
+
+    def get_mean_jitter(self):
+        if self.num_steps == 0:
+            return 0.0
+        return float(self.sum_jitter) / self.num_steps
+
+
+class Player():
+    '''
+    Sends a sequence of move commands at absolute deadlines on a monotonic
+    nanosecond clock, so delays of single transfers do not add up over the
+    program. Each transfer is started early by the measured mean latency of
+    the previous transfers.
+    '''
+
+    def __init__(self, usb_arm, clock=time.monotonic_ns, sleep=time.sleep):
+        self.usb_arm = usb_arm
+        self.clock = clock
+        self.sleep = sleep
+        self.latency = 0
+
+    def wait_until(self, deadline):
+        while True:
+            remaining = deadline - self.clock()
+            if remaining <= 0:
+                return
+            if remaining > SPIN_NS:
+                self.sleep((remaining - SPIN_NS) / 1e9)
+            else:
+                # spins through the sleep hook, so an injected clock which
+                # only advances when sleeping still reaches the deadline
+                self.sleep(0)
+
+    def transfer(self, move_cmd):
+        try:
+            self.usb_arm.ctrl_transfer(0x40, 6, 0x100, 0, move_cmd, 1000)
+        except Exception as e:
+            metrics.count_transfer_error(e)
+            raise
+
+    def run(self, steps, start=None, keep_samples=True):
+        '''
+        Plays the (timespan, move_cmd) pairs of steps and returns a
+        JitterReport. start is the clock value of the first deadline and
+        defaults to now.
+        '''
+        report = JitterReport(keep_samples)
+        deadline = self.clock() if start is None else start
+        for timespan, move_cmd in steps:
+            self.wait_until(deadline - self.latency)
+            sent = self.clock()
+            self.transfer(move_cmd)
+            done = self.clock()
+            self.latency = self.latency + (done - sent - self.latency) // 4
+            metrics.PLAYBACK_TRANSFER_SECONDS.observe((done - sent) / 1e9)
+            report.add(deadline, sent, done)
+            deadline = deadline + int(timespan * 1e9)
+        self.wait_until(deadline)
+        return report
+
+
+class MappedProgram():
+    '''
+    A read only program backed by a memory mapped binary program file. Steps
+    are decoded when they are accessed.
+    '''
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise ValueError('Not a binary program: %s' % path)
+        if len(self.map) < BINARY_HEADER.size:
+            self.close()
+            raise ValueError('Not a binary program: %s' % path)
+        magic, version, _, num_steps = BINARY_HEADER.unpack_from(self.map, 0)
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            self.close()
+            raise ValueError('Not a binary program: %s' % path)
+        if len(self.map) < (BINARY_HEADER.size
+                            + num_steps * BINARY_RECORD.size):
+            self.close()
+            raise ValueError('Truncated binary program: %s' % path)
+        self.num_steps = num_steps
+        self.ends = None
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __len__(self):
+        return self.num_steps
+
+    def __getitem__(self, i):
+        if i < 0:
+            i = i + self.num_steps
+        if i < 0 or i >= self.num_steps:
+            raise IndexError('program index out of range')
+        v = BINARY_RECORD.unpack_from(
+            self.map, BINARY_HEADER.size + i * BINARY_RECORD.size)
+        return MoveCmd(v[0], [v[1], v[2], v[3]], [v[4], v[5], v[6]])
+
+    def __iter__(self):
+        for i in range(self.num_steps):
+            yield self[i]
+
+    def get_column(self, name, offset, size):
+        '''
+        Returns the bytes of one field of all records. With numpy the records
+        are viewed as one structured array, else the bytes are gathered
+        with strided slices, so no record is unpacked one by one.
+        '''
+        if np is not None:
+            records = np.frombuffer(self.map, RECORD_DTYPE, self.num_steps,
+                                    BINARY_HEADER.size)
+            data = records[name].tobytes()
+            del records
+            return data
+        start = BINARY_HEADER.size
+        records = self.map[start:start + self.num_steps * BINARY_RECORD.size]
+        data = bytearray(size * self.num_steps)
+        for k in range(size):
+            data[k::size] = records[offset + k::BINARY_RECORD.size]
+        return bytes(data)
+
+    def get_timespans(self):
+        timespans = array('d')
+        timespans.frombytes(self.get_column('timespan', 0, 8))
+        if sys.byteorder == 'big':
+            timespans.byteswap()
+        return timespans
+
+    def get_end_times(self):
+        if self.ends is None:
+            timespans = self.get_timespans()
+            if np is not None:
+                self.ends = array('d', np.cumsum(
+                    np.frombuffer(timespans, np.float64)).tobytes())
+            else:
+                self.ends = array(
+                    'd', list(itertools.accumulate(timespans)))
+        return self.ends
+
+    def to_program(self):
+        '''
+        Returns the steps as Program, copying the columns directly.
+        '''
+        program = Program()
+        program.timespans = self.get_timespans()
+        program.cmds = bytearray(self.get_column('cmds', 8, 6))
+        program.ends = array('d', self.get_end_times())
+        return program
+
+    def get_runtime(self):
+        ends = self.get_end_times()
+        if len(ends) == 0:
+            return 0.0
+        return ends[-1]
+
+
+def iter_slice(program, t0, t1, reverse=False):
+    '''
+    Yields the steps of the part of program between the times t0 and t1,
+    starting with the step active at the first time (the last one if
+    reversed). The first and last step are shortened to the bounds.
+    '''
+    ends = program.get_end_times()
+    if reverse is True:
+        i = bisect.bisect_left(ends, t1)
+        for j in range(min(i, len(ends) - 1), -1, -1):
+            mc = program[j]
+            start = max(ends[j] - mc.timespan, t0)
+            end = min(ends[j], t1)
+            if end <= t0:
+                break
+            yield MoveCmd(end - start, mc.move_cmd, mc.move_cmd_reverse)
+    else:
+        i = bisect.bisect_right(ends, t0)
+        for j in range(i, len(ends)):
+            mc = program[j]
+            start = max(ends[j] - mc.timespan, t0)
+            end = min(ends[j], t1)
+            if start >= t1:
+                break
+            yield MoveCmd(end - start, mc.move_cmd, mc.move_cmd_reverse)
+
+
+def slice_steps(program, t0, t1, reverse=False):
+    '''
+    Yields the (timespan, move_cmd) pairs of iter_slice, with the reversed
+    move commands if reverse is set.
+    '''
+    for mc in iter_slice(program, t0, t1, reverse):
+        if reverse is True:
+            yield (mc.timespan, mc.move_cmd_reverse)
+        else:
+            yield (mc.timespan, mc.move_cmd)
+
+
+def net_joint_times(program):
+    '''
+    Returns for every joint the signed time in seconds it is moved by the
+    program, up (or clockwise, close, on) counting positive.
+    '''
+    times = [0.0] * len(JOINTS)
+    for mc in program:
+        for j, (name, byte, shift) in enumerate(JOINTS):
+            s = (mc.move_cmd[byte] >> shift) & 3
+            if s == 1:
+                times[j] = times[j] + mc.timespan
+            elif s == 2:
+                times[j] = times[j] - mc.timespan
+    return times
+
+
+class OptimizeReport():
+
+    def __init__(self, transfers_saved, runtime_saved, max_joint_error):
+        self.transfers_saved = transfers_saved
+        self.runtime_saved = runtime_saved
+        self.max_joint_error = max_joint_error
+
+
+def joint_directions(move_cmd):
+    '''
+    Returns for every joint 1 if move_cmd moves it up (or clockwise, close,
+    on), -1 if it moves it down and 0 otherwise.
+    '''
+    directions = []
+    for name, byte, shift in JOINTS:
+        s = (move_cmd[byte] >> shift) & 3
+        directions.append(1 if s == 1 else (-1 if s == 2 else 0))
+    return directions
+
+
+def optimize_program(program, min_timespan=0.05, tolerance=0.1):
+    '''
+    Returns a compacted copy of program and an OptimizeReport. Adjacent
+    steps with the same command are merged into one first. Then every step
+    still shorter than min_timespan is handled: a stop is dropped with its
+    time, so a short stop between two equal moves folds them into one step
+    and the joints keep their net time. A short move is absorbed into the
+    neighbour which changes the net time of the joints least, by adding its
+    time to that neighbour, as long as the net time of every joint changes
+    by at most tolerance seconds. The last step is always kept.
+    '''
+    merged = []
+    for mc in program:
+        if len(merged) > 0 and merged[-1][1] == list(mc.move_cmd):
+            merged[-1][0] = merged[-1][0] + mc.timespan
+        else:
+            merged.append([mc.timespan, list(mc.move_cmd),
+                           list(mc.move_cmd_reverse)])
+    steps = []
+    error = [0.0] * len(JOINTS)
+    pending = 0.0
+    n = len(merged)
+    for i, (timespan, move_cmd, move_cmd_reverse) in enumerate(merged):
+        timespan = timespan + pending
+        pending = 0.0
+        if i < n - 1 and timespan < min_timespan:
+            own = joint_directions(move_cmd)
+            if own == [0] * len(JOINTS):
+                continue
+            best = None
+            neighbours = [('next', merged[i + 1][1])]
+            if len(steps) > 0:
+                neighbours.insert(0, ('previous', steps[-1][1]))
+            for side, neighbour in neighbours:
+                e = [error[j] + (d - own[j]) * timespan
+                     for j, d in enumerate(joint_directions(neighbour))]
+                worst = max([abs(v) for v in e])
+                if worst <= tolerance and (best is None or worst < best[0]):
+                    best = (worst, side, e)
+            if best is not None:
+                error = best[2]
+                if best[1] == 'previous':
+                    steps[-1][0] = steps[-1][0] + timespan
+                else:
+                    pending = timespan
+                continue
+        if len(steps) > 0 and steps[-1][1] == move_cmd:
+            steps[-1][0] = steps[-1][0] + timespan
+            continue
+        steps.append([timespan, move_cmd, move_cmd_reverse])
+    optimized = Program()
+    for timespan, move_cmd, move_cmd_reverse in steps:
+        optimized.append_step(timespan, move_cmd, move_cmd_reverse)
+    before = net_joint_times(program)
+    after = net_joint_times(optimized)
+    report = OptimizeReport(
+        len(program) - len(optimized),
+        program.get_runtime() - optimized.get_runtime(),
+        max([abs(b - a) for b, a in zip(before, after)]))
+    return optimized, report
+
+
+def is_binary_program(path):
+    f = open(path, 'rb')
+    magic = f.read(len(BINARY_MAGIC))
+    f.close()
+    return magic == BINARY_MAGIC
+
+
+def read_text_program(path):
+    f = open(path, 'r')
+    for l in f:
+        yield parse_text_step(l.rstrip('\n'))
+    f.close()
+
+
+def temp_path(path):
+    '''
+    Returns the path a program is written to before it replaces path, so a
+    memory mapped program can be saved over its own file.
+    '''
+    return '%s.%d.tmp' % (path, os.getpid())
+
+
+def write_text_program(path, program):
+    tmp = temp_path(path)
+    f = open(tmp, 'w')
+    for mc in program:
+        f.write('%f %d %d %d %d %d %d\n' % (mc.timespan,
+                                            mc.move_cmd[0],
+                                            mc.move_cmd[1],
+                                            mc.move_cmd[2],
+                                            mc.move_cmd_reverse[0],
+                                            mc.move_cmd_reverse[1],
+                                            mc.move_cmd_reverse[2]))
+    f.close()
+    os.replace(tmp, path)
+
+
+def write_binary_program(path, program):
+    tmp = temp_path(path)
+    f = open(tmp, 'wb')
+    f.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, 0, 0))
+    n = 0
+    for mc in program:
+        f.write(BINARY_RECORD.pack(mc.timespan,
+                                   mc.move_cmd[0],
+                                   mc.move_cmd[1],
+                                   mc.move_cmd[2],
+                                   mc.move_cmd_reverse[0],
+                                   mc.move_cmd_reverse[1],
+                                   mc.move_cmd_reverse[2]))
+        n = n + 1
+    f.seek(0)
+    f.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, 0, n))
+    f.close()
+    os.replace(tmp, path)
+
+
+def parse_text_step(l):
+    v = l.split(' ')
+    return MoveCmd(float(v[0]),
+                   [int(v[1]), int(v[2]), int(v[3])],
+                   [int(v[4]), int(v[5]), int(v[6])])
+
+
+def iter_text_program_reverse(path):
+    f = open(path, 'rb')
+    f.seek(0, os.SEEK_END)
+    pos = f.tell()
+    rest = b''
+    while pos > 0:
+        n = min(pos, STREAM_CHUNK * 64)
+        pos = pos - n
+        f.seek(pos)
+        lines = (f.read(n) + rest).split(b'\n')
+        rest = lines[0]
+        for l in reversed(lines[1:]):
+            if len(l) > 0:
+                yield parse_text_step(l.decode('ascii'))
+    if len(rest) > 0:
+        yield parse_text_step(rest.decode('ascii'))
+    f.close()
+
+
+def iter_binary_program(path, reverse=False):
+    f = open(path, 'rb')
+    magic, version, _, num_steps = BINARY_HEADER.unpack(
+        f.read(BINARY_HEADER.size))
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        f.close()
+        raise ValueError('Not a binary program: %s' % path)
+    chunks = range(0, num_steps, STREAM_CHUNK)
+    if reverse is True:
+        chunks = reversed(chunks)
+    for first in chunks:
+        n = min(STREAM_CHUNK, num_steps - first)
+        f.seek(BINARY_HEADER.size + first * BINARY_RECORD.size)
+        data = f.read(n * BINARY_RECORD.size)
+        if len(data) < n * BINARY_RECORD.size:
+            f.close()
+            raise ValueError('Truncated binary program: %s' % path)
+        records = BINARY_RECORD.iter_unpack(data)
+        if reverse is True:
+            records = reversed(list(records))
+        for v in records:
+            yield MoveCmd(v[0], [v[1], v[2], v[3]], [v[4], v[5], v[6]])
+    f.close()
+
+
+def iter_program(path, reverse=False):
+    '''
+    Lazily reads the steps of a text or binary program file, in reversed
+    order if requested, without loading the whole file.
+    '''
+    if is_binary_program(path):
+        return iter_binary_program(path, reverse)
+    if reverse is True:
+        return iter_text_program_reverse(path)
+    return read_text_program(path)
+
+
+def prefetch(steps, window=STREAM_WINDOW):
+    '''
+    Reads steps in a background thread, at most window items ahead of the
+    consumer.
+    '''
+    q = queue.Queue(maxsize=window)
+    end = object()
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for step in steps:
+                if not put((step, None)):
+                    return
+            put((end, None))
+        except Exception as e:
+            put((end, e))
+
+    t = threading.Thread(target=produce)
+    t.daemon = True
+    t.start()
+    try:
+        while True:
+            step, error = q.get()
+            if error is not None:
+                raise error
+            if step is end:
+                return
+            yield step
+    finally:
+        stopped.set()
+
+
+def text_to_binary(src, dst):
+    write_binary_program(dst, read_text_program(src))
+
+
+def binary_to_text(src, dst):
+    program = MappedProgram(src)
+    write_text_program(dst, program)
+    program.close()
+
+
 class Recorder():
 
     def __init__(self, usb_arm):
         self.usb_arm = usb_arm
+        self.player = Player(usb_arm)
         self.recording = False
-        self.start_time = time.time()
-        self.program = []
+        self.start_time = clock()
+        self.program = Program()
+        self.sessions = []
+        self.session_pending = False
+
+    def set_program(self, program):
+        '''
+        Replaces the program and closes the file of a memory mapped one.
+        '''
+        if self.program is not program and hasattr(self.program, 'close'):
+            self.program.close()
+        self.program = program
 
     def start_record(self):
-        self.start_time = time.time()
+        if isinstance(self.program, MappedProgram):
+            self.set_program(self.program.to_program())
+        elif not isinstance(self.program, Program):
+            self.set_program(Program(self.program))
+            self.sessions = []
+        self.start_time = clock()
         self.recording = True
+        if len(self.program) > 0:
+            self.sessions.append((len(self.program) - 1, self.start_time))
+        else:
+            self.session_pending = True
 
     def stop_record(self):
-        self.start_time = time.time()
+        self.start_time = clock()
         self.recording = False
-        self.program.append(MoveCmd(0.0, [0, 0, 0], [0, 0, 0]))
+        self.program.append_step(0.0, [0, 0, 0], [0, 0, 0])
 
     def clear_record(self):
-        self.start_time = time.time()
+        self.start_time = clock()
         self.recording = False
-        self.program = []
+        self.set_program(Program())
+        self.sessions = []
+        self.session_pending = False
 
     def get_num_steps(self):
         return len(self.program)
 
     def get_runtime(self):
-        t = 0.0
-        for mc in self.program:
-            t = t + mc.timespan
-        return t
+        return self.program.get_runtime()
 
     def add_move_cmd(self, move_cmd, move_cmd_reverse):
         if self.recording is True:
             logging.debug('Recorder: add move')
-            t = time.time() - self.start_time
-            self.start_time = time.time()
+            metrics.RECORDER_APPENDS.inc()
+            now = clock()
+            t = now - self.start_time
+            self.start_time = now
+            if self.session_pending is True:
+                self.sessions.append((len(self.program), now))
+                self.session_pending = False
             if len(self.program) > 0:
-                self.program[-1].timespan = t
-            self.program.append(MoveCmd(0.0, move_cmd, move_cmd_reverse))
+                self.program.set_timespan(-1, t)
+            self.program.append_step(0.0, move_cmd, move_cmd_reverse)
+
+    def optimize(self, min_timespan=0.05, tolerance=0.1):
+        '''
+        Compacts the program with optimize_program. The steps and their times
+        change, so the recorded clock times of the sessions are dropped.
+        '''
+        if self.recording is False:
+            program, report = optimize_program(self.program, min_timespan,
+                                               tolerance)
+            self.set_program(program)
+            self.sessions = []
+            self.session_pending = False
+            return report
+
+    def get_slice(self, c0, c1):
+        '''
+        Returns the part of the recorded program between the clock values c0
+        and c1 as Program, which starts at c0. The time before, between and
+        after the recording sessions is filled with stop steps and the slice
+        always ends with a stop. A step is only complete once the next one
+        was recorded.
+        '''
+        if len(self.sessions) == 0:
+            raise ValueError('The program has no recorded clock times')
+        ends = self.program.get_end_times()
+        steps = []
+
+        def add(mc):
+            if list(mc.move_cmd) == [0, 0, 0] and len(steps) > 0 \
+                    and list(steps[-1].move_cmd) == [0, 0, 0]:
+                mc = MoveCmd(steps.pop().timespan + mc.timespan,
+                             mc.move_cmd, mc.move_cmd_reverse)
+            steps.append(mc)
+
+        def stop(timespan):
+            add(MoveCmd(timespan, [0, 0, 0], [0, 0, 0]))
+
+        c = c0
+        for k, (first, origin) in enumerate(self.sessions):
+            base = 0.0
+            if first > 0:
+                base = ends[first - 1]
+            end = self.program.get_runtime()
+            if k + 1 < len(self.sessions):
+                end = ends[self.sessions[k + 1][0] - 1]
+            s0 = max(c, origin)
+            s1 = min(c1, origin + end - base)
+            if s1 <= s0:
+                continue
+            if s0 > c:
+                stop(s0 - c)
+            for mc in iter_slice(self.program, base + s0 - origin,
+                                 base + s1 - origin):
+                add(mc)
+            c = s1
+        if c1 > c:
+            stop(c1 - c)
+        stop(0.0)
+        return Program(steps)
 
     def play(self):
         if self.recording is False:
-            for mc in self.program:
-                self.usb_arm.ctrl_transfer(0x40, 6, 0x100, 0,
-                                           mc.move_cmd, 1000)
-                time.sleep(mc.timespan)
+            return self.player.run((mc.timespan, mc.move_cmd)
+                                   for mc in self.program)
 
     def play_reverse(self):
         if self.recording is False:
-            for mc in reversed(self.program):
-                self.usb_arm.ctrl_transfer(0x40, 6, 0x100, 0,
-                                           mc.move_cmd_reverse, 1000)
-                time.sleep(mc.timespan)
-            self.usb_arm.ctrl_transfer(0x40, 6, 0x100, 0,
-                                       [0, 0, 0], 1000)
+            steps = [(mc.timespan, mc.move_cmd_reverse)
+                     for mc in reversed(self.program)]
+            steps.append((0.0, [0, 0, 0]))
+            return self.player.run(steps)
+
+    def play_range(self, t0, t1, reverse=False):
+        '''
+        Plays the part of the program between the times t0 and t1 in seconds
+        and stops the arm at its end. Reversed it runs from t1 back to t0.
+        '''
+        if self.recording is False:
+            steps = itertools.chain(slice_steps(self.program, t0, t1, reverse),
+                                    [(0.0, [0, 0, 0])])
+            return self.player.run(steps)
+
+    def play_from(self, seconds, reverse=False):
+        '''
+        Plays the program from the time seconds to its end, or reversed from
+        seconds back to its start.
+        '''
+        if reverse is True:
+            return self.play_range(0.0, seconds, True)
+        return self.play_range(seconds, self.get_runtime())
+
+    def play_file(self, path, reverse=False, window=STREAM_WINDOW):
+        '''
+        Plays a saved program while streaming it from the file, so only a
+        window of steps is held in memory.
+        '''
+        if self.recording is False:
+            steps = prefetch(iter_program(path, reverse), window)
+            if reverse is True:
+                pairs = itertools.chain(((mc.timespan, mc.move_cmd_reverse)
+                                         for mc in steps),
+                                        [(0.0, [0, 0, 0])])
+            else:
+                pairs = ((mc.timespan, mc.move_cmd) for mc in steps)
+            return self.player.run(pairs, keep_samples=False)
 
     def save(self, path):
         if self.recording is False:
-            f = open(path, 'w')
-            for mc in self.program:
-                f.write('%f %d %d %d %d %d %d\n' % (mc.timespan,
-                                                    mc.move_cmd[0],
-                                                    mc.move_cmd[1],
-                                                    mc.move_cmd[2],
-                                                    mc.move_cmd_reverse[0],
-                                                    mc.move_cmd_reverse[1],
-                                                    mc.move_cmd_reverse[2]))
-            f.close()
+            write_text_program(path, self.program)
+
+    def save_binary(self, path):
+        if self.recording is False:
+            write_binary_program(path, self.program)
 
     def open(self, path):
         if self.recording is False:
-            f = open(path, 'r')
-            lines = [line.rstrip('\n') for line in f]
-            f.close()
-            self.program = []
-            self.start_time = time.time()
-            for l in lines:
-                v = l.split(' ')
-                move_cmd = [int(v[1]), int(v[2]), int(v[3])]
-                move_cmd_reverse = [int(v[4]), int(v[5]), int(v[6])]
-                self.program.append(MoveCmd(float(v[0]), move_cmd, move_cmd_reverse))
+            self.start_time = clock()
+            self.sessions = []
+            if is_binary_program(path):
+                self.set_program(MappedProgram(path))
+            else:
+                self.set_program(Program(read_text_program(path)))
@@ -0,0 +1,157 @@
+# MIT License
+#
+# Copyright (c) 2015-2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+A simulated arm, which can be used instead of the USB device to run the
+library without the arm attached.
+'''
+
+import argparse
+import errno
+import random
+import threading
+import time
+import usb.core
+from arm import COMPONENTS, RoboticArm
+
+# the default speeds of the joints in degrees per second, for the gripper in
+# percent of its opening per second
+SPEEDS = {'base': 20.0, 'shoulder': 15.0, 'elbow': 20.0, 'wrist': 30.0,
+          'gripper': 40.0}
+
+# the default end stops of the joints, relative to the start position
+LIMITS = {'base': (-135.0, 135.0), 'shoulder': (-90.0, 90.0),
+          'elbow': (-150.0, 150.0), 'wrist': (-60.0, 60.0),
+          'gripper': (-100.0, 0.0)}
+
+
+class SimulatedArm():
+    '''
+    Implements ctrl_transfer of the USB device. The three bytes of every
+    move command are decoded into the states of the components and the
+    position of every joint is integrated over time with its speed, state 1
+    moving it up and state 2 down, until it hits an end stop. Every
+    transfer takes latency seconds and fails with a timeout with the
+    probability failure_rate.
+    '''
+
+    def __init__(self, speeds=None, limits=None, latency=0.0,
+                 failure_rate=0.0, seed=None, clock=time.monotonic,
+                 sleep=time.sleep):
+        self.speeds = dict(SPEEDS)
+        if speeds is not None:
+            self.speeds.update(speeds)
+        self.limits = dict(LIMITS)
+        if limits is not None:
+            self.limits.update(limits)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.components = [(name, cls()) for name, cls in COMPONENTS]
+        self.states = dict((name, 0) for name, cls in COMPONENTS)
+        self.positions = dict((name, 0.0) for name in self.speeds)
+        self.updated = self.clock()
+        self.num_transfers = 0
+        self.num_failures = 0
+        self.num_end_stops = 0
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue=0, wIndex=0,
+                      data_or_wLength=None, timeout=None):
+        if (bmRequestType != 0x40 or bRequest != 6 or wValue != 0x100
+                or data_or_wLength is None or len(data_or_wLength) != 3):
+            raise usb.core.USBError('Pipe error', -9, errno.EPIPE)
+        if self.latency > 0:
+            self.sleep(self.latency)
+        if self.random.random() < self.failure_rate:
+            with self.lock:
+                self.num_failures = self.num_failures + 1
+            raise usb.core.USBTimeoutError('Operation timed out', -7,
+                                           errno.ETIMEDOUT)
+        with self.lock:
+            self.update()
+            for name, c in self.components:
+                self.states[name] = (data_or_wLength[c.byte] // c.factor) & 3
+            self.num_transfers = self.num_transfers + 1
+        return 3
+
+    def update(self):
+        now = self.clock()
+        elapsed = now - self.updated
+        self.updated = now
+        for name, speed in self.speeds.items():
+            state = self.states[name]
+            if state == 0:
+                continue
+            low, high = self.limits[name]
+            step = speed * elapsed
+            position = self.positions[name] + (step if state == 1 else -step)
+            if position > high or position < low:
+                position = max(low, min(high, position))
+                self.num_end_stops = self.num_end_stops + 1
+            self.positions[name] = position
+
+    def get_positions(self):
+        '''
+        Returns the current position of every joint.
+        '''
+        with self.lock:
+            self.update()
+            return dict(self.positions)
+
+    def get_states(self):
+        with self.lock:
+            return dict(self.states)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Move a simulated arm and print the positions of its '
+        'joints.')
+    parser.add_argument('-l', '--latency', type=float, default=0.001,
+                        help='The seconds every transfer takes.')
+    parser.add_argument('-f', '--failure-rate', type=float, default=0.0,
+                        help='The probability of a failed transfer.')
+    parser.add_argument('moves', nargs='*', default=['shoulder=up:1'],
+                        help='Moves as component=state:seconds.')
+    args = parser.parse_args()
+    device = SimulatedArm(latency=args.latency,
+                          failure_rate=args.failure_rate)
+    robotic_arm = RoboticArm(usb_arm=device)
+    for move in args.moves:
+        name, rest = move.split('=')
+        state, seconds = rest.split(':')
+        try:
+            robotic_arm.apply({name: state})
+            handle = robotic_arm.move_for(float(seconds))
+            handle.wait()
+            if handle.error is not None:
+                print('Stop of %s failed: %s' % (name, handle.error))
+        except usb.core.USBError as e:
+            print('Move of %s failed: %s' % (name, e))
+    for name, position in sorted(device.get_positions().items()):
+        print('%-10s %8.2f' % (name, position))
+    print('%d transfers, %d failed' % (device.num_transfers,
+                                       device.num_failures))
+    robotic_arm.close()
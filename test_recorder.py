@@ -0,0 +1,191 @@
+# MIT License
+#
+# Copyright (c) 2015-2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Tests of the program optimizer, which replay the original and the optimized
+program against a fake arm and compare the time every joint moved.
+'''
+
+import random
+import unittest
+import recorder
+from arm import MOVE_TABLE, MOVE_REVERSE_TABLE
+from recorder import (JOINTS, MoveCmd, Player, Program, Recorder,
+                      net_joint_times, optimize_program)
+
+SHOULDER_UP = 1 << 6
+SHOULDER_DOWN = 2 << 6
+ELBOW_UP = 1 << 4
+
+
+class FakeClock():
+    '''
+    A nanosecond clock which only advances when sleeping, by at least 10
+    microseconds per call.
+    '''
+
+    def __init__(self):
+        self.now = 0
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now = self.now + max(10000, int(seconds * 1e9))
+
+
+class FakeArm():
+    '''
+    Integrates the time every joint moved from the transfers it receives.
+    '''
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.times = [0.0] * len(JOINTS)
+        self.cmd = [0, 0, 0]
+        self.since = 0
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue, wIndex, cmd,
+                      timeout):
+        now = self.clock.clock()
+        elapsed = (now - self.since) / 1e9
+        for j, d in enumerate(net_joint_times([MoveCmd(1.0, self.cmd,
+                                                       self.cmd)])):
+            self.times[j] = self.times[j] + d * elapsed
+        self.cmd = list(cmd)
+        self.since = now
+
+
+def replay(program):
+    clock = FakeClock()
+    arm = FakeArm(clock)
+    Player(arm, clock.clock, clock.sleep).run(
+        [(mc.timespan, mc.move_cmd) for mc in program])
+    return arm.times
+
+
+def step(timespan, move_cmd):
+    state = 0
+    for value in range(len(MOVE_TABLE)):
+        if list(MOVE_TABLE[value]) == move_cmd:
+            state = value
+            break
+    return MoveCmd(timespan, move_cmd, list(MOVE_REVERSE_TABLE[state]))
+
+
+class OptimizeProgramTest(unittest.TestCase):
+
+    def check(self, program, tolerance=0.1):
+        optimized, report = optimize_program(program, tolerance=tolerance)
+        before = replay(program)
+        after = replay(optimized)
+        for b, a in zip(before, after):
+            self.assertLessEqual(abs(b - a), tolerance + 1e-6)
+        self.assertLessEqual(report.max_joint_error, tolerance + 1e-9)
+        self.assertGreaterEqual(report.runtime_saved, 0.0)
+        self.assertAlmostEqual(program.get_runtime() - report.runtime_saved,
+                               optimized.get_runtime())
+        return optimized, report
+
+    def test_continuous_short_steps(self):
+        program = Program([step(0.02, [SHOULDER_UP, 0, 0])
+                           for i in range(10)] + [step(0.0, [0, 0, 0])])
+        optimized, report = self.check(program)
+        self.assertEqual(len(optimized), 2)
+        self.assertAlmostEqual(optimized[0].timespan, 0.2)
+        self.assertAlmostEqual(report.runtime_saved, 0.0)
+        self.assertAlmostEqual(report.max_joint_error, 0.0)
+
+    def test_short_stop_between_equal_moves(self):
+        program = Program([step(0.5, [SHOULDER_UP, 0, 0]),
+                           step(0.01, [0, 0, 0]),
+                           step(0.5, [SHOULDER_UP, 0, 0]),
+                           step(0.0, [0, 0, 0])])
+        optimized, report = self.check(program)
+        self.assertEqual(len(optimized), 2)
+        self.assertEqual(report.transfers_saved, 2)
+        self.assertAlmostEqual(optimized[0].timespan, 1.0)
+        self.assertAlmostEqual(report.runtime_saved, 0.01)
+        self.assertAlmostEqual(report.max_joint_error, 0.0)
+
+    def test_tolerance_keeps_short_moves(self):
+        program = Program([step(0.04, [SHOULDER_UP, 0, 0]),
+                           step(0.5, [ELBOW_UP, 0, 0]),
+                           step(0.04, [SHOULDER_DOWN, 0, 0]),
+                           step(0.0, [0, 0, 0])])
+        optimized, report = self.check(program, tolerance=0.01)
+        self.assertEqual(len(optimized), len(program))
+
+    def test_random_recording(self):
+        rng = random.Random(1)
+        cmds = [[0, 0, 0], [SHOULDER_UP, 0, 0], [SHOULDER_DOWN, 0, 0],
+                [ELBOW_UP, 0, 0], [SHOULDER_UP | ELBOW_UP, 1, 0]]
+        program = Program([step(rng.choice([0.01, 0.02, 0.03, 0.3]),
+                                rng.choice(cmds)) for i in range(500)]
+                          + [step(0.0, [0, 0, 0])])
+        optimized, report = self.check(program)
+        self.assertLess(len(optimized), len(program))
+
+
+
+class GetSliceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.clock = recorder.clock
+        recorder.clock = lambda: self.now
+
+    def tearDown(self):
+        recorder.clock = self.clock
+
+    def at(self, now, action, *args):
+        self.now = now
+        action(*args)
+
+    def test_gaps_are_stops(self):
+        rec = Recorder(usb_arm=None)
+        stop = ([0, 0, 0], [0, 0, 0])
+        self.at(10.0, rec.start_record)
+        self.at(11.0, rec.add_move_cmd, [SHOULDER_UP, 0, 0],
+                [SHOULDER_DOWN, 0, 0])
+        self.at(12.0, rec.add_move_cmd, *stop)
+        self.at(12.5, rec.stop_record)
+        self.at(20.0, rec.start_record)
+        self.at(21.0, rec.add_move_cmd, [ELBOW_UP, 0, 0], [2 << 4, 0, 0])
+        self.at(22.0, rec.add_move_cmd, *stop)
+        self.at(22.5, rec.stop_record)
+        program = rec.get_slice(9.0, 23.0)
+        self.assertEqual([(mc.timespan, list(mc.move_cmd)) for mc in program],
+                         [(2.0, [0, 0, 0]), (1.0, [SHOULDER_UP, 0, 0]),
+                          (9.0, [0, 0, 0]), (1.0, [ELBOW_UP, 0, 0]),
+                          (1.0, [0, 0, 0])])
+        self.assertAlmostEqual(program.get_runtime(), 14.0)
+
+    def test_no_sessions(self):
+        rec = Recorder(usb_arm=None)
+        rec.set_program(Program([step(1.0, [SHOULDER_UP, 0, 0]),
+                                 step(0.0, [0, 0, 0])]))
+        self.assertRaises(ValueError, rec.get_slice, 0.0, 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -26,14 +26,33 @@ A web application to control the arm based on flask.
 
 from flask import Flask, jsonify, render_template, request, Response
 import argparse
-from camera import CameraStream
-from arm import RoboticArm
+import json
+import os
+import threading
+import time
+from camera import (get_shared_camera, ChangeDetector, FrameRing,
+                    DEFAULT_QUALITY)
+from arm import RoboticArm, COMPONENTS, COMPONENT_NAMES, state_texts
+import metrics
+import recorder
+
+
+try:
+    from flask_sock import Sock
+except ImportError:
+    Sock = None
 
 
 robotic_arm = RoboticArm()
 camera_number = 0
+camera_detector = None
+camera_ring = None
+export_dir = '.'
 app = Flask(__name__, static_folder='web/static',
             template_folder='web/templates')
+sock = None
+if Sock is not None:
+    sock = Sock(app)
 
 
 @app.route('/')
@@ -43,7 +62,135 @@ def index():
 
 @app.route('/control')
 def control():
-    return render_template('control.html')
+    return render_template('control.html', websocket=sock is not None)
+
+
+def arm_state():
+    return state_texts(robotic_arm.packed.value)
+
+
+class WebSocketClients():
+    '''
+    The connected websocket clients. Messages are compact strings: 's' and
+    one character per component in the order of COMPONENT_NAMES, a digit
+    for its state or '-' to keep it, and 'p' with any payload which is
+    echoed back as 'P' for measuring the round trip time.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.thread = None
+
+    def add(self, ws):
+        with self.lock:
+            self.clients[ws] = threading.Lock()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        version, state = robotic_arm.feed.get()
+        while True:
+            version, state = robotic_arm.feed.wait(version)
+            self.broadcast(compact_state(state))
+
+    def remove(self, ws):
+        with self.lock:
+            self.clients.pop(ws, None)
+
+    def send(self, ws, message):
+        with self.lock:
+            lock = self.clients.get(ws)
+        if lock is not None:
+            with lock:
+                ws.send(message)
+
+    def broadcast(self, message):
+        with self.lock:
+            clients = list(self.clients)
+        for ws in clients:
+            try:
+                self.send(ws, message)
+            except Exception:
+                self.remove(ws)
+
+
+websocket_clients = WebSocketClients()
+
+
+def compact_state(state):
+    return 's' + ''.join(str((state >> cls.shift) & 3)
+                         for name, cls in COMPONENTS)
+
+
+def apply_compact_state(message):
+    changes = {}
+    for name, c in zip(COMPONENT_NAMES, message[1:]):
+        if c != '-':
+            changes[name] = int(c)
+    robotic_arm.apply(changes)
+
+
+def websocket(ws):
+    websocket_clients.add(ws)
+    try:
+        websocket_clients.send(ws, compact_state(robotic_arm.packed.value))
+        while True:
+            message = ws.receive()
+            if message is None:
+                break
+            if message.startswith('p'):
+                websocket_clients.send(ws, 'P' + message[1:])
+            elif message.startswith('s'):
+                try:
+                    apply_compact_state(message)
+                except ValueError:
+                    websocket_clients.send(
+                        ws, compact_state(robotic_arm.packed.value))
+    finally:
+        websocket_clients.remove(ws)
+
+
+if sock is not None:
+    sock.route('/ws')(websocket)
+
+
+@app.route('/state', methods=['GET', 'POST'])
+def state():
+    if request.method == 'POST':
+        changes = request.get_json(force=True, silent=True)
+        if not isinstance(changes, dict):
+            return jsonify(error='Expected a JSON object'), 400
+        try:
+            robotic_arm.apply(changes)
+        except ValueError as e:
+            return jsonify(error=str(e)), 400
+    return jsonify(arm_state())
+
+
+def state_events(version):
+    while True:
+        v, state = robotic_arm.feed.wait(version, 15.0)
+        if v == version:
+            yield ': keepalive\n\n'
+            continue
+        version = v
+        yield 'id: %d\ndata: %s\n\n' % (version,
+                                          json.dumps(state_texts(state)))
+
+
+@app.route('/events')
+def events():
+    '''
+    Streams the state of the arm as server sent events whenever it changes.
+    A client resuming with the Last-Event-ID of the current version only
+    receives later changes.
+    '''
+    version = request.headers.get('Last-Event-ID', type=int)
+    return Response(state_events(version), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
 
 
 @app.route('/base')
@@ -148,28 +295,83 @@ def stop():
 
 @app.route('/cam')
 def cam():
-    return render_template('cam.html')
+    return render_template('cam.html', websocket=sock is not None)
 
 
-def gen(camera):
-    while True:
-        frame = camera.get_frame()
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n\r\n')
+def gen(frames):
+    for frame in frames:
+        yield b'--frame\r\nContent-Type: image/jpeg\r\n\r\n'
+        yield frame
+        yield b'\r\n\r\n'
 
 
 @app.route('/video_feed')
 def video_feed():
-    return Response(gen(CameraStream(camera_number)),
+    width = request.args.get('width', None, type=int)
+    quality = request.args.get('quality', DEFAULT_QUALITY, type=int)
+    max_fps = request.args.get('fps', None, type=float)
+    if width is not None and width <= 0:
+        width = None
+    quality = min(max(quality, 1), 100)
+    camera = get_shared_camera(camera_number, camera_detector, camera_ring)
+    return Response(gen(camera.frames(width, quality, max_fps)),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
 
+@app.route('/video_stats')
+def video_stats():
+    return jsonify(get_shared_camera(camera_number, camera_detector,
+                                     camera_ring).get_report())
+
+
+@app.route('/video_export', methods=['POST'])
+def video_export():
+    '''
+    Exports the images of the last seconds kept in the frame ring as a clip
+    to the export directory.
+    '''
+    if camera_ring is None:
+        return jsonify(error='The server keeps no frame ring'), 404
+    seconds = request.args.get('seconds', 10.0, type=float)
+    c1 = recorder.clock()
+    path = os.path.join(export_dir,
+                        time.strftime('clip-%Y%m%d-%H%M%S'))
+    frames = camera_ring.export(path, c1 - seconds, c1)
+    return jsonify(path=path + '.avi', frames=frames)
+
+
+@app.route('/metrics')
+def metrics_text():
+    return Response(metrics.REGISTRY.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='A web controller for the Robotic Arm Kit.')
     parser.add_argument('-c', '--camera',
                         help='The system number of the camera.', required=False)
+    parser.add_argument('-s', '--sensitivity', type=float,
+                        help='Skip camera frames whose mean pixel difference '
+                        'to the last sent one is below this value.',
+                        required=False)
+    parser.add_argument('-k', '--keyframe-interval', type=int, default=30,
+                        help='Send at least every n-th camera frame when '
+                        'skipping unchanged ones.', required=False)
+    parser.add_argument('-r', '--ring-mb', type=int,
+                        help='Keep the latest camera images in a ring of '
+                        'this many megabytes, exported by POST '
+                        '/video_export.', required=False)
+    parser.add_argument('-e', '--export-dir', default='.',
+                        help='The directory of the exported clips.',
+                        required=False)
     args = parser.parse_args()
+    if args.ring_mb is not None:
+        camera_ring = FrameRing(args.ring_mb * 1024 * 1024)
+    export_dir = args.export_dir
     if args.camera is not None:
         camera_number = int(args.camera)
+    if args.sensitivity is not None:
+        camera_detector = ChangeDetector(args.sensitivity,
+                                         args.keyframe_interval)
     app.run(debug=True, threaded=True)
@@ -0,0 +1,329 @@
+# MIT License
+#
+# Copyright (c) 2015-2018 Josef Wachtler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+A production server for web.py based on asyncio and aiohttp. All control
+routes, the state events and the video feed are served by one event loop
+without a thread per connection, blocking USB transfers and JPEG encodes
+run on a small bounded thread pool.
+'''
+
+from aiohttp import web as aioweb
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import json
+import time
+from arm import COMPONENT_NAMES, state_texts
+from camera import get_shared_camera, ChangeDetector, DEFAULT_QUALITY
+import metrics
+import web
+
+
+class Broadcast():
+    '''
+    Wakes up the coroutines waiting for a value, which is published from any
+    thread.
+    '''
+
+    def __init__(self, loop, value):
+        self.loop = loop
+        self.value = value
+        self.cond = asyncio.Condition()
+
+    def publish(self, *value):
+        self.loop.call_soon_threadsafe(self.update, value)
+
+    def update(self, value):
+        self.value = value
+        self.loop.create_task(self.notify())
+
+    async def notify(self):
+        async with self.cond:
+            self.cond.notify_all()
+
+    async def wait(self, value, timeout=None):
+        '''
+        Waits until the value differs from the given one and returns it.
+        '''
+        async with self.cond:
+            if self.value == value:
+                try:
+                    await asyncio.wait_for(self.cond.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return self.value
+
+
+def render_page(template):
+    with web.app.test_request_context():
+        return web.render_template(template, websocket=True)
+
+
+async def run_blocking(request, func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(request.app['executor'], func, *args)
+
+
+async def page(request):
+    return aioweb.Response(text=request.app['pages'][request.path],
+                           content_type='text/html')
+
+
+async def component(request):
+    name = request.match_info['name']
+    try:
+        status = int(request.query.get('status', 0))
+    except ValueError:
+        status = 0
+    if status in (0, 1, 2):
+        try:
+            await run_blocking(request, web.robotic_arm.apply, {name: status})
+        except ValueError:
+            pass
+    c = getattr(web.robotic_arm, name)
+    return aioweb.json_response({'result': c.state,
+                                 'result_text': c.get_state_text()})
+
+
+async def stop(request):
+    await run_blocking(request, web.robotic_arm.stop)
+    return aioweb.json_response({'result': 0, 'result_text': 'Stopped'})
+
+
+async def state(request):
+    if request.method == 'POST':
+        try:
+            changes = await request.json()
+        except ValueError:
+            changes = None
+        if not isinstance(changes, dict):
+            return aioweb.json_response({'error': 'Expected a JSON object'},
+                                        status=400)
+        try:
+            await run_blocking(request, web.robotic_arm.apply, changes)
+        except ValueError as e:
+            return aioweb.json_response({'error': str(e)}, status=400)
+    return aioweb.json_response(web.arm_state())
+
+
+async def events(request):
+    version = request.headers.get('Last-Event-ID')
+    version = int(version) if version is not None and version.isdigit() \
+        else None
+    response = aioweb.StreamResponse(headers={
+        'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+    await response.prepare(request)
+    feed = request.app['feed']
+    try:
+        await stream_events(response, feed, version)
+    except ConnectionResetError:
+        pass
+    return response
+
+
+async def stream_events(response, feed, version):
+    while True:
+        value = feed.value
+        if value[0] == version:
+            value = await feed.wait(value, 15.0)
+            if value[0] == version:
+                await response.write(b': keepalive\n\n')
+                continue
+        version, s = value
+        await response.write(('id: %d\ndata: %s\n\n' % (
+            version, json.dumps(state_texts(s)))).encode('ascii'))
+
+
+async def websocket(request):
+    ws = aioweb.WebSocketResponse()
+    await ws.prepare(request)
+    request.app['websockets'].add(ws)
+    try:
+        await ws.send_str(web.compact_state(web.robotic_arm.packed.value))
+        async for message in ws:
+            if message.type != aioweb.WSMsgType.TEXT:
+                continue
+            if message.data.startswith('p'):
+                await ws.send_str('P' + message.data[1:])
+            elif message.data.startswith('s'):
+                try:
+                    await run_blocking(request, web.apply_compact_state,
+                                       message.data)
+                except ValueError:
+                    await ws.send_str(
+                        web.compact_state(web.robotic_arm.packed.value))
+    finally:
+        request.app['websockets'].discard(ws)
+    return ws
+
+
+async def push_states(app):
+    version = app['feed'].value
+    while True:
+        version = await app['feed'].wait(version)
+        message = web.compact_state(version[1])
+        for ws in list(app['websockets']):
+            try:
+                await ws.send_str(message)
+            except Exception:
+                app['websockets'].discard(ws)
+
+
+async def video_feed(request):
+    try:
+        width = int(request.query['width'])
+    except (KeyError, ValueError):
+        width = None
+    try:
+        quality = int(request.query.get('quality', DEFAULT_QUALITY))
+    except ValueError:
+        quality = DEFAULT_QUALITY
+    quality = min(max(quality, 1), 100)
+    try:
+        max_fps = float(request.query['fps'])
+    except (KeyError, ValueError):
+        max_fps = None
+    if width is not None and width <= 0:
+        width = None
+    min_interval = 1.0 / max_fps if max_fps is not None and max_fps > 0 \
+        else 0.0
+    camera = request.app['camera']
+    frames = request.app['frames']
+    response = aioweb.StreamResponse(headers={
+        'Content-Type': 'multipart/x-mixed-replace; boundary=frame'})
+    await response.prepare(request)
+    camera.open()
+    try:
+        await stream_frames(request, response, camera, frames, width, quality,
+                            min_interval)
+    except ConnectionResetError:
+        pass
+    finally:
+        camera.close()
+    return response
+
+
+async def stream_frames(request, response, camera, frames, width, quality,
+                        min_interval):
+    '''
+    Writes the frames of camera like SharedCamera.frames() does, waiting at
+    least twice the time the last frame took to be written.
+    '''
+    seq = None
+    sent = 0.0
+    write_time = 0.0
+    while True:
+        s = await frames.wait((seq,), 1.0)
+        if s == (seq,):
+            continue
+        wait = sent + max(min_interval, 2 * write_time) - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        seq, image = camera.wait_image(None)
+        if image is None:
+            continue
+        try:
+            frame = camera.get_cached(seq, width, quality)
+            if frame is None:
+                frame = await run_blocking(request, camera.get_encoded, seq,
+                                           image, width, quality)
+        finally:
+            camera.release(image)
+        sent = time.monotonic()
+        await response.write(b'--frame\r\nContent-Type: image/jpeg\r\n\r\n')
+        await response.write(frame)
+        await response.write(b'\r\n\r\n')
+        write_time = (write_time * 3 + time.monotonic() - sent) / 4
+
+
+async def video_stats(request):
+    return aioweb.json_response(request.app['camera'].get_report())
+
+
+async def metrics_text(request):
+    return aioweb.Response(
+        body=metrics.REGISTRY.render().encode('utf-8'),
+        headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+
+async def start_background(app):
+    loop = asyncio.get_running_loop()
+    app['feed'] = Broadcast(loop, web.robotic_arm.feed.get())
+    web.robotic_arm.feed.add_listener(app['feed'].publish)
+    app['frames'] = Broadcast(loop, (app['camera'].seq,))
+    app['camera'].add_listener(app['frames'].publish)
+    app['push_states'] = loop.create_task(push_states(app))
+
+
+async def stop_background(app):
+    app['push_states'].cancel()
+    app['executor'].shutdown(wait=False)
+
+
+def create_app(camera_number=0, detector=None, workers=4):
+    app = aioweb.Application()
+    app['executor'] = ThreadPoolExecutor(max_workers=workers)
+    app['camera'] = get_shared_camera(camera_number, detector)
+    app['websockets'] = set()
+    app['pages'] = {'/': render_page('index.html'),
+                    '/control': render_page('control.html'),
+                    '/cam': render_page('cam.html')}
+    for path in app['pages']:
+        app.router.add_get(path, page)
+    app.router.add_get('/state', state)
+    app.router.add_post('/state', state)
+    app.router.add_get('/stop', stop)
+    app.router.add_get('/events', events)
+    app.router.add_get('/ws', websocket)
+    app.router.add_get('/video_feed', video_feed)
+    app.router.add_get('/video_stats', video_stats)
+    app.router.add_get('/metrics', metrics_text)
+    app.router.add_get('/{name:%s}' % '|'.join(COMPONENT_NAMES), component)
+    app.router.add_static('/static', 'web/static')
+    app.on_startup.append(start_background)
+    app.on_cleanup.append(stop_background)
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='A production web controller for the Robotic Arm Kit.')
+    parser.add_argument('-c', '--camera', type=int, default=0,
+                        help='The system number of the camera.')
+    parser.add_argument('-p', '--port', type=int, default=8080,
+                        help='The port to listen on.')
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='The number of threads for blocking calls.')
+    parser.add_argument('-s', '--sensitivity', type=float,
+                        help='Skip camera frames whose mean pixel difference '
+                        'to the last sent one is below this value.')
+    parser.add_argument('-k', '--keyframe-interval', type=int, default=30,
+                        help='Send at least every n-th camera frame when '
+                        'skipping unchanged ones.')
+    args = parser.parse_args()
+    detector = None
+    if args.sensitivity is not None:
+        detector = ChangeDetector(args.sensitivity, args.keyframe_interval)
+    web.camera_number = args.camera
+    aioweb.run_app(create_app(args.camera, detector, args.workers),
+                   port=args.port)
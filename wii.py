@@ -24,18 +24,182 @@
 Control the arm using a wii-mote.
 '''
 
+import argparse
 import cwiid
+import queue
 import time
 from arm import RoboticArm
 
+# the tilt from the calibrated position, in accelerometer counts, at which
+# the arm stops and reaches full speed in proportional mode
+DEAD_TILT = 10
+FULL_TILT = 35
+
+
+def sign(value):
+    if value > 0:
+        return 1
+    if value < 0:
+        return -1
+    return 0
+
+
+def threshold_direction(tilt, threshold=DEAD_TILT):
+    if abs(tilt) > threshold:
+        return sign(tilt)
+    return 0
+
+
+class TiltFilter():
+    '''
+    Turns the samples of one accelerometer axis into a direction of -1, 0
+    or 1. The samples are smoothed with exponentially decaying weights over
+    a ring of the last size samples. A direction is entered beyond
+    threshold + band and kept until the tilt falls below threshold - band,
+    and a new direction must be held for min_dwell seconds before it is
+    taken.
+    '''
+
+    def __init__(self, center, threshold=DEAD_TILT, band=3, alpha=0.3,
+                 size=8, min_dwell=0.05):
+        self.center = center
+        self.enter = threshold + band
+        self.leave = threshold - band
+        self.min_dwell = min_dwell
+        weights = [(1.0 - alpha) ** k for k in range(size)]
+        self.weights = [w / sum(weights) for w in weights]
+        self.samples = [center] * size
+        self.index = 0
+        self.value = center
+        self.direction = 0
+        self.candidate = 0
+        self.since = 0.0
+
+    def update(self, value, now):
+        size = len(self.samples)
+        self.index = (self.index + 1) % size
+        self.samples[self.index] = value
+        smoothed = 0.0
+        for k in range(size):
+            sample = self.samples[(self.index - k) % size]
+            smoothed = smoothed + self.weights[k] * sample
+        self.value = smoothed
+        tilt = smoothed - self.center
+        if abs(tilt) > self.enter:
+            candidate = sign(tilt)
+        elif self.direction != 0 and tilt * self.direction > self.leave:
+            candidate = self.direction
+        else:
+            candidate = 0
+        if candidate == self.direction:
+            self.candidate = candidate
+        elif candidate != self.candidate:
+            self.candidate = candidate
+            self.since = now
+        elif now - self.since >= self.min_dwell:
+            self.direction = candidate
+        return self.direction
+
+
+def compute_changes(buttons, roll, pitch):
+    '''
+    Maps the buttons and the directions of the roll and the pitch to the
+    states of the components.
+    '''
+    changes = {}
+    changes['base'] = {1: 'clockwise', -1: 'anticlockwise', 0: 'stop'}[roll]
+    changes['shoulder'] = {1: 'down', -1: 'up', 0: 'stop'}[pitch]
+
+    if (buttons & cwiid.BTN_UP):
+        changes['elbow'] = 'up'
+    elif (buttons & cwiid.BTN_DOWN):
+        changes['elbow'] = 'down'
+    else:
+        changes['elbow'] = 'stop'
+
+    if (buttons & cwiid.BTN_A):
+        changes['wrist'] = 'up'
+    elif (buttons & cwiid.BTN_B):
+        changes['wrist'] = 'down'
+    else:
+        changes['wrist'] = 'stop'
+
+    if (buttons & cwiid.BTN_LEFT):
+        changes['gripper'] = 'open'
+    elif (buttons & cwiid.BTN_RIGHT):
+        changes['gripper'] = 'close'
+    else:
+        changes['gripper'] = 'stop'
+
+    if (buttons & cwiid.BTN_PLUS):
+        changes['light'] = 'on'
+    elif (buttons & cwiid.BTN_MINUS):
+        changes['light'] = 'off'
+    return changes
+
+
+def read_trace(path):
+    '''
+    Yields the calibration and then the time, buttons and acceleration of
+    every sample of a trace written by WiiMote.
+    '''
+    with open(path) as f:
+        roll_start, pitch_start = [int(v) for v in f.readline().split()[1:]]
+        yield roll_start, pitch_start
+        for line in f:
+            values = line.split()
+            yield (float(values[0]), int(values[1]),
+                   tuple(int(v) for v in values[2:5]))
+
+
+def count_transfers(path, filter_options=None):
+    '''
+    Replays a trace and returns the number of state changes, and so
+    transfers, it causes, with a TiltFilter per axis if filter_options are
+    given.
+    '''
+    samples = read_trace(path)
+    roll_start, pitch_start = next(samples)
+    if filter_options is not None:
+        roll_filter = TiltFilter(roll_start, **filter_options)
+        pitch_filter = TiltFilter(pitch_start, **filter_options)
+    last = None
+    count = 0
+    for now, buttons, acc in samples:
+        if filter_options is not None:
+            roll = roll_filter.update(acc[0], now)
+            pitch = pitch_filter.update(acc[1], now)
+        else:
+            roll = threshold_direction(acc[0] - roll_start)
+            pitch = threshold_direction(acc[1] - pitch_start)
+        changes = compute_changes(buttons, roll, pitch)
+        if changes != last:
+            count = count + 1
+            last = changes
+    return count
+
 
 class WiiMote():
 
-    def __init__(self):
+    def __init__(self, max_rate=50.0, proportional=False,
+                 filter_options=None, trace_path=None):
         self.wm = None
         self.wm_roll_start = 0
         self.wm_pitch_start = 0
         self.robotic_arm = RoboticArm()
+        self.max_rate = max_rate
+        self.proportional = proportional
+        self.filter_options = filter_options
+        self.filters = None
+        self.trace_path = trace_path
+        self.trace = None
+        self.roll = 0
+        self.pitch = 0
+        self.events = queue.Queue()
+        self.buttons = 0
+        self.acc = (0, 0, 0)
+        self.latencies = []
+        self.wakeups = 0
         print('Robotic Arm controlled by Wiimote!')
 
 
@@ -99,69 +263,204 @@ class WiiMote():
             time.sleep(0.01)
 
         self.wm.led = 3
-        print self.wm_roll_start
-        print self.wm_pitch_start
+        print(self.wm_roll_start)
+        print(self.wm_pitch_start)
         print('Calibrated!')
 
 
+    def directions(self, acc, now):
+        '''
+        Returns the directions of the roll and the pitch of the wiimote.
+        '''
+        if self.trace is not None:
+            self.trace.write('%.6f %d %d %d %d\n' % (
+                now, self.buttons, acc[0], acc[1], acc[2]))
+        if self.filters is not None:
+            return (self.filters[0].update(acc[0], now),
+                    self.filters[1].update(acc[1], now))
+        return (threshold_direction(acc[0] - self.wm_roll_start),
+                threshold_direction(acc[1] - self.wm_pitch_start))
+
+    def start_input(self):
+        if self.filter_options is not None:
+            self.filters = (
+                TiltFilter(self.wm_roll_start, **self.filter_options),
+                TiltFilter(self.wm_pitch_start, **self.filter_options))
+        if self.trace_path is not None:
+            self.trace = open(self.trace_path, 'w')
+            self.trace.write('# %d %d\n' % (self.wm_roll_start,
+                                             self.wm_pitch_start))
+
+    def stop_input(self):
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
+    def compute_speeds(self, acc):
+        '''
+        Maps the tilt to the speeds of the base and the shoulder, which grow
+        from zero at DEAD_TILT to full speed at FULL_TILT.
+        '''
+        speeds = {}
+        for name, tilt in (('base', acc[0] - self.wm_roll_start),
+                           ('shoulder', self.wm_pitch_start - acc[1])):
+            speed = float(abs(tilt) - DEAD_TILT) / (FULL_TILT - DEAD_TILT)
+            speed = max(0.0, min(1.0, speed))
+            speeds[name] = speed if tilt > 0 else -speed
+        return speeds
+
+    def on_message(self, mesg_list, timestamp=None):
+        self.events.put((time.monotonic(), mesg_list))
+
+    def handle_messages(self, mesg_list):
+        for mesg in mesg_list:
+            if mesg[0] == cwiid.MESG_BTN:
+                self.buttons = mesg[1]
+            elif mesg[0] == cwiid.MESG_ACC:
+                self.acc = mesg[1]
+                self.roll, self.pitch = self.directions(self.acc,
+                                                        time.monotonic())
+            elif mesg[0] == cwiid.MESG_ERROR:
+                self.buttons = cwiid.BTN_HOME
+
     def run(self):
+        '''
+        Waits for the messages of the wiimote and only moves the arm when the
+        computed state changed, at most max_rate times per second. Messages
+        arriving in between are combined. In proportional mode the base and
+        the shoulder are moved with a speed following the tilt.
+        '''
         self.print_help()
+        self.start_input()
+        self.wm.mesg_callback = self.on_message
+        self.wm.enable(cwiid.FLAG_MESG_IFC)
+        cpu = time.process_time()
+        wall = time.monotonic()
+        last = None
+        sent = 0.0
         while True:
-            if (self.wm.state['buttons'] & cwiid.BTN_HOME):
+            received, mesg_list = self.events.get()
+            self.wakeups = self.wakeups + 1
+            self.handle_messages(mesg_list)
+            wait = sent + 1.0 / self.max_rate - time.monotonic()
+            while wait > 0:
+                try:
+                    r, mesg_list = self.events.get(timeout=wait)
+                except queue.Empty:
+                    break
+                self.wakeups = self.wakeups + 1
+                self.handle_messages(mesg_list)
+                wait = sent + 1.0 / self.max_rate - time.monotonic()
+            if (self.buttons & cwiid.BTN_HOME):
                 self.robotic_arm.stop()
                 break
-
-            lt = self.wm_roll_start - 10
-            rt = self.wm_roll_start + 10
-            if (self.wm.state['acc'][0] < lt):
-                self.robotic_arm.base.set_anticlockwise()
-            elif (self.wm.state['acc'][0] > rt):
-                self.robotic_arm.base.set_clockwise()
+            changes = compute_changes(self.buttons, self.roll, self.pitch)
+            if self.proportional is True:
+                del changes['base']
+                del changes['shoulder']
+                if self.filters is not None:
+                    speeds = self.compute_speeds(
+                        (self.filters[0].value, self.filters[1].value))
+                else:
+                    speeds = self.compute_speeds(self.acc)
             else:
-                self.robotic_arm.base.set_stop()
-
-            ut = self.wm_pitch_start - 10
-            dt = self.wm_pitch_start + 10
-            if (self.wm.state['acc'][1] < ut):
-                self.robotic_arm.shoulder.set_up()
-            elif (self.wm.state['acc'][1] > dt):
-                self.robotic_arm.shoulder.set_down()
-            else:
-                self.robotic_arm.shoulder.set_stop()
-
-            if (self.wm.state['buttons'] & cwiid.BTN_UP):
-                self.robotic_arm.elbow.set_up()
-            elif (self.wm.state['buttons'] & cwiid.BTN_DOWN):
-                self.robotic_arm.elbow.set_down()
-            else:
-                self.robotic_arm.elbow.set_stop()
+                speeds = None
+            if (changes, speeds) != last:
+                if speeds is not None:
+                    self.robotic_arm.set_speeds(speeds)
+                self.robotic_arm.apply(changes)
+                sent = time.monotonic()
+                self.latencies.append(sent - received)
+                last = (changes, speeds)
+        self.wm.disable(cwiid.FLAG_MESG_IFC)
+        self.stop_input()
+        self.print_stats(time.process_time() - cpu, time.monotonic() - wall)
 
-            if (self.wm.state['buttons'] & cwiid.BTN_A):
-                self.robotic_arm.wrist.set_up()
-            elif (self.wm.state['buttons'] & cwiid.BTN_B):
-                self.robotic_arm.wrist.set_down()
-            else:
-                self.robotic_arm.wrist.set_stop()
-
-            if (self.wm.state['buttons'] & cwiid.BTN_LEFT):
-                self.robotic_arm.gripper.set_open()
-            elif (self.wm.state['buttons'] & cwiid.BTN_RIGHT):
-                self.robotic_arm.gripper.set_close()
-            else:
-                self.robotic_arm.gripper.set_stop()
-
-            if (self.wm.state['buttons'] & cwiid.BTN_PLUS):
-                self.robotic_arm.light.set_on()
-            elif (self.wm.state['buttons'] & cwiid.BTN_MINUS):
-                self.robotic_arm.light.set_off()
-
-            #print self.wm.state['acc']
-            self.robotic_arm.move()
+    def run_polling(self):
+        '''
+        Reads the state of the wiimote every 10 ms, the former way of control
+        kept for comparison.
+        '''
+        self.print_help()
+        self.start_input()
+        cpu = time.process_time()
+        wall = time.monotonic()
+        while True:
+            polled = time.monotonic()
+            self.wakeups = self.wakeups + 1
+            state = self.wm.state
+            if (state['buttons'] & cwiid.BTN_HOME):
+                self.robotic_arm.stop()
+                break
+            self.buttons = state['buttons']
+            roll, pitch = self.directions(state['acc'], polled)
+            state_before = self.robotic_arm.packed.value
+            self.robotic_arm.apply(compute_changes(self.buttons, roll, pitch))
+            if self.robotic_arm.packed.value != state_before:
+                self.latencies.append(time.monotonic() - polled)
             time.sleep(0.01)
+        self.stop_input()
+        self.print_stats(time.process_time() - cpu, time.monotonic() - wall)
+
+    def print_stats(self, cpu, wall):
+        '''
+        Prints the CPU usage, the number of times the loop woke up and the
+        time from reading an input to sending the new state.
+        '''
+        latencies = sorted(self.latencies)
+        print(' ')
+        print('CPU: %.1f %% of %.1f s' % (100.0 * cpu / max(wall, 1e-9), wall))
+        print('Wake-ups: %d (%.0f per second)' % (
+            self.wakeups, self.wakeups / max(wall, 1e-9)))
+        pwm = self.robotic_arm.pwm
+        if pwm is not None and pwm.num_ticks > 0:
+            print('Speed ticks: jitter mean %.2f ms, max %.2f ms, %d overruns'
+                  % (pwm.get_mean_jitter() / 1e6, pwm.get_max_jitter() / 1e6,
+                     pwm.num_overruns))
+        if len(latencies) > 0:
+            print('Input to transfer latency: mean %.2f ms, max %.2f ms, '
+                  '%d transfers' % (1000.0 * sum(latencies) / len(latencies),
+                                    1000.0 * latencies[-1], len(latencies)))
 
 
 if __name__ == '__main__':
-    wiim = WiiMote()
+    parser = argparse.ArgumentParser(
+        description='Control the Robotic Arm Kit with a wiimote.')
+    parser.add_argument('-r', '--max-rate', type=float, default=50.0,
+                        help='The maximum number of commands per second.')
+    parser.add_argument('-p', '--poll', action='store_true',
+                        help='Poll the wiimote every 10 ms instead of '
+                        'waiting for its messages.')
+    parser.add_argument('-s', '--speed', action='store_true',
+                        help='Move the base and the shoulder with a speed '
+                        'proportional to the tilt.')
+    parser.add_argument('-f', '--filter', action='store_true',
+                        help='Smooth the tilt and switch it with hysteresis.')
+    parser.add_argument('--alpha', type=float, default=0.3,
+                        help='The smoothing factor of the filter.')
+    parser.add_argument('--band', type=float, default=3,
+                        help='The half width of the hysteresis band.')
+    parser.add_argument('--dwell', type=float, default=0.05,
+                        help='The seconds a new direction must be held.')
+    parser.add_argument('-t', '--trace',
+                        help='Write the input of the wiimote to this file.')
+    parser.add_argument('--replay',
+                        help='Print the transfers caused by a trace without '
+                        'and with the filter and exit.')
+    args = parser.parse_args()
+    filter_options = dict(alpha=args.alpha, band=args.band,
+                          min_dwell=args.dwell)
+    if args.replay is not None:
+        print('Transfers without filter: %d' % count_transfers(args.replay))
+        print('Transfers with filter: %d' % count_transfers(args.replay,
+                                                           filter_options))
+        quit()
+    if args.filter is False:
+        filter_options = None
+    wiim = WiiMote(args.max_rate, args.speed, filter_options, args.trace)
     wiim.connect()
     wiim.calibrate()
-    wiim.run()
+    if args.poll is True:
+        wiim.run_polling()
+    else:
+        wiim.run()